@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+"""Benchmark makesite.py on a generated site.
+
+Generates a reproducible site of AO3 works and Markdown posts, builds it
+with makesite.main() in a new process for each run and prints the wall
+time, the time spent in each phase of the build and the peak memory use
+of each run as JSON, e.g.:
+
+    python benchmark.py --works 1000 --chapters 3 --posts 200 > before.json
+
+Runs after the first one use the parse cache, unless makesite.py is given
+--no-cache after --.
+"""
+
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import makesite
+
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+         'tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam '
+         'quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo '
+         'consequat duis aute irure in reprehenderit voluptate velit esse cillum '
+         'fugiat nulla pariatur excepteur sint occaecat cupidatat non proident sunt '
+         'culpa qui officia deserunt mollit anim id est laborum').split()
+
+RATINGS = ('General Audiences', 'Teen And Up Audiences', 'Mature', 'Explicit')
+WARNINGS = ('No Archive Warnings Apply', 'Creator Chose Not To Use Archive Warnings')
+CATEGORIES = ('F/F', 'F/M', 'Gen', 'M/M', 'Multi', 'Other')
+
+AO3_WORK = '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+<head>
+  <meta charset="utf-8"/>
+  <title>{title} - {author} - {fandom}</title>
+</head>
+<body>
+
+<div id="preface">
+  <h2 class="toc-heading">Preface</h2>
+
+  <p class="message">
+    <b>{title}</b><br/>
+    Posted originally on the <a href="http://archiveofourown.org/">Archive of Our Own</a> at <a href="http://archiveofourown.org/works/{id}">http://archiveofourown.org/works/{id}</a>.
+  </p>
+
+  <div class="meta">
+    <dl class="tags">
+{tags}
+        <dt>Language:</dt>
+        <dd>English</dd>
+{series}
+      <dt>Stats:</dt>
+      <dd>
+        Published: {date}
+        Words: {words:,}
+        Chapters: {chapter_count}/{chapter_count}
+      </dd>
+    </dl>
+    <h1>{title}</h1>
+    <div class="byline">by <a rel="author" href="http://archiveofourown.org/users/{author}">{author}</a></div>
+      <p>Summary</p>
+      <blockquote class="userstuff">{summary}</blockquote>
+{notes}
+  </div>
+</div>
+
+<div id="chapters" class="userstuff">
+{chapters}
+</div>
+
+<div id="afterword">
+  <h2 class="toc-heading">Afterword</h2>
+
+  <p class="message">Please <a href="http://archiveofourown.org/works/{id}/comments/new">drop by the archive and comment</a> to let the author know if you enjoyed their work!</p>
+</div>
+
+</body>
+</html>
+'''
+
+AO3_CHAPTER = '''
+<div class="meta group">
+  <h2 class="heading">Chapter {number}</h2>
+</div>
+
+<!--chapter content-->
+<div class="userstuff">
+{text}
+</div>
+<!--/chapter content-->
+'''
+
+
+def sentence(rng, words=12):
+    """Return a random sentence."""
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return text.capitalize() + '.'
+
+
+def paragraphs(rng, count, sentences=5):
+    """Return a list of random paragraphs."""
+    return [' '.join(sentence(rng) for _ in range(sentences)) for _ in range(count)]
+
+
+def title(rng, words=4):
+    """Return a random title."""
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).title()
+
+
+def tag_list(label, tags):
+    """Return the AO3 definition list entry for some tags."""
+    links = ', '.join('<a href="http://archiveofourown.org/tags/{0}">{0}</a>'.format(tag)
+                      for tag in tags)
+    return '          <dt>{}:</dt>\n          <dd>{}</dd>'.format(label, links)
+
+
+def make_ao3_work(rng, work_id, fandoms, series, chapters, length):
+    """Return the HTML of an AO3 download of a random work."""
+    fandom = rng.sample(fandoms, rng.choice((1, 1, 1, 2)))
+    characters = ['{} {}'.format(title(rng, 1), title(rng, 1)) for _ in range(rng.randint(1, 4))]
+    tags = [
+        tag_list('Rating', [rng.choice(RATINGS)]),
+        tag_list('Archive Warning', [rng.choice(WARNINGS)]),
+        tag_list('Category', [rng.choice(CATEGORIES)]),
+        tag_list('Fandom', fandom),
+        tag_list('Relationship', ['/'.join(characters[:2])]),
+        tag_list('Character', characters),
+        tag_list('Additional Tags', [title(rng, 2) for _ in range(rng.randint(0, 6))]),
+    ]
+    series_text = ''
+    if series and rng.random() < 0.3:
+        names = sorted(series)
+        name = rng.choice(names)
+        series[name] += 1
+        series_text = ('        <dt>Series:</dt>\n        <dd> Part {} of\n'
+                       '<a href="http://archiveofourown.org/series/{}">{}</a> </dd>'
+                       .format(series[name], names.index(name), name))
+    chapter_html = []
+    words = 0
+    for number in range(1, chapters + 1):
+        text = paragraphs(rng, length)
+        words += sum(len(p.split()) for p in text)
+        chapter_html.append(AO3_CHAPTER.format(
+            number=number, text='\n\n'.join('<p>{}</p>'.format(p) for p in text)))
+    notes = ''
+    if rng.random() < 0.5:
+        notes = '      <p>Notes</p>\n      <blockquote class="userstuff"><p>{}</p></blockquote>'.format(sentence(rng))
+    date = datetime.date(2010, 1, 1) + datetime.timedelta(days=rng.randrange(5000))
+    return AO3_WORK.format(
+        id=work_id, title=title(rng), author='Author {}'.format(rng.randrange(10)),
+        fandom=', '.join(fandom), tags='\n'.join(tags), series=series_text,
+        date=date.isoformat(), words=words, chapter_count=chapters,
+        summary='<p>{}</p>'.format(sentence(rng, 30)), notes=notes,
+        chapters='\n'.join(chapter_html))
+
+
+def make_post(rng, length):
+    """Return the filename and Markdown text of a random post."""
+    date = datetime.date(2015, 1, 1) + datetime.timedelta(days=rng.randrange(3000))
+    post_title = title(rng)
+    lines = ['<!-- title: {} -->'.format(post_title),
+             '<!-- tags: {}, {} -->'.format(rng.choice(WORDS), rng.choice(WORDS)), '']
+    for text in paragraphs(rng, length):
+        if rng.random() < 0.3:
+            lines += ['## ' + title(rng, 3), '']
+        lines += [text, '']
+    filename = '{}-{}.md'.format(date.isoformat(), post_title.lower().replace(' ', '-'))
+    return filename, '\n'.join(lines)
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def generate(site_dir, works=100, chapters=3, posts=50, folders=3, depth=2,
+             fandoms=20, series=10, length=5, seed=0):
+    """Generate a site in site_dir and return the params for its params.json.
+
+    AO3 works are spread over `folders` folders of works, and Markdown
+    posts over a tree of folders `depth` levels deep. Every folder has an
+    _index file. The same arguments always generate the same site.
+    """
+    rng = random.Random(seed)
+    content_dir = os.path.join(site_dir, 'content')
+    write(os.path.join(content_dir, '_index.md'),
+          '<!-- title: Benchmark -->\n\n' + '\n\n'.join(paragraphs(rng, 2)))
+
+    fandom_names = ['{} ({})'.format(title(rng, 2), rng.choice(('TV', 'Movies', 'Comics', 'Books')))
+                    for _ in range(fandoms)]
+    series_parts = {'{} Series'.format(title(rng, 2)): 0 for _ in range(series)}
+    work_dirs = [os.path.join(content_dir, 'works{}'.format(i) if i else 'works')
+                 for i in range(max(folders, 1))]
+    for work_dir in work_dirs:
+        write(os.path.join(work_dir, '_index.md'), '<!-- title: {} -->\n'.format(title(rng, 2)))
+    for work_id in range(works):
+        work_chapters = rng.randint(1, chapters) if chapters > 1 else 1
+        text = make_ao3_work(rng, work_id, fandom_names, series_parts, work_chapters, length)
+        write(os.path.join(work_dirs[work_id % len(work_dirs)], 'work{}.html'.format(work_id)), text)
+
+    post_dirs = [os.path.join(content_dir, 'blog')]
+    for level in range(1, depth):
+        post_dirs.append(os.path.join(post_dirs[-1], 'part{}'.format(level)))
+    for post_dir in post_dirs:
+        write(os.path.join(post_dir, '_index.md'), '<!-- title: {} -->\n'.format(title(rng, 2)))
+    for i in range(posts):
+        filename, text = make_post(rng, length)
+        write(os.path.join(post_dirs[i % len(post_dirs)], filename), text)
+
+    # Group the first fandoms together, as sites with many works usually do.
+    groups = [fandom_names[i:i + 3] for i in range(0, min(fandoms, 9), 3)]
+    return {'tag_processing': {'fandom_groups': [group for group in groups if len(group) > 1]}}
+
+
+def peak_rss(who='self'):
+    """Return the peak resident set size in KiB of this process, or of its largest child.
+
+    The peak is over the lifetime of the process, which is why each build
+    is run in a process of its own.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere.
+    return usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+
+
+def build(site_dir, argv):
+    """Build the site in site_dir in this process and return the timings of the build."""
+    os.chdir(site_dir)
+    # makesite.py logs every file it reads and writes.
+    sys.stderr = open(os.devnull, 'w')
+    start = time.perf_counter()
+    result = makesite.main(argv)
+    wall = time.perf_counter() - start
+    # main() returns None when skip_unchanged found nothing to build.
+    phases = {name: round(seconds, 4) for name, seconds in sorted(result.timings.items())} if result else {}
+    return {
+        'wall': round(wall, 4),
+        'skipped': result is None,
+        'phases': phases,
+        'peak_rss_kib': peak_rss(),
+        'workers_peak_rss_kib': peak_rss('children'),
+    }
+
+
+def run(site_dir, argv):
+    """Build the site in site_dir in a new process and return the timings of the build.
+
+    peak_rss_kib is the peak memory use of that process and
+    workers_peak_rss_kib the peak of the largest of its worker processes,
+    if --workers was used.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(build, os.path.abspath(site_dir), argv).result()
+
+
+def parse_args(argv):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--works', type=int, default=100, help='number of AO3 works (default: 100)')
+    parser.add_argument('--chapters', type=int, default=3,
+                        help='maximum number of chapters in a work (default: 3)')
+    parser.add_argument('--posts', type=int, default=50, help='number of Markdown posts (default: 50)')
+    parser.add_argument('--folders', type=int, default=3, help='number of folders of works (default: 3)')
+    parser.add_argument('--depth', type=int, default=2, help='depth of the folders of posts (default: 2)')
+    parser.add_argument('--fandoms', type=int, default=20, help='number of fandoms (default: 20)')
+    parser.add_argument('--series', type=int, default=10, help='number of series (default: 10)')
+    parser.add_argument('--length', type=int, default=5,
+                        help='paragraphs in each chapter or post (default: 5)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    parser.add_argument('--theme', default='default', help='theme to build with (default: default)')
+    parser.add_argument('--params', default='{}', metavar='JSON', help='extra params for params.json')
+    parser.add_argument('--runs', type=int, default=2, help='number of builds (default: 2)')
+    parser.add_argument('--dir', help='generate the site in this folder and keep it')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    parser.add_argument('makesite_args', nargs='*', metavar='-- ARGS',
+                        help='arguments for makesite.py, e.g. -- --no-cache --workers 4')
+    return parser.parse_args(argv)
+
+
+def main(argv=()):
+    args = parse_args(argv)
+    corpus = {name: getattr(args, name) for name in
+              ('works', 'chapters', 'posts', 'folders', 'depth', 'fandoms', 'series', 'length', 'seed')}
+    site_dir = args.dir or tempfile.mkdtemp(prefix='makesite-benchmark-')
+    try:
+        if os.path.isdir(os.path.join(site_dir, 'content')):
+            shutil.rmtree(os.path.join(site_dir, 'content'))
+        start = time.perf_counter()
+        params = generate(site_dir, **corpus)
+        generate_time = time.perf_counter() - start
+        params.update(json.loads(args.params))
+        params.setdefault('theme', args.theme)
+        with open(os.path.join(site_dir, 'params.json'), 'w') as f:
+            json.dump(params, f, indent=2)
+        themes_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'themes')
+        if not os.path.isdir(os.path.join(site_dir, 'themes')):
+            shutil.copytree(themes_dir, os.path.join(site_dir, 'themes'))
+
+        runs = [run(site_dir, args.makesite_args) for _ in range(args.runs)]
+    finally:
+        if not args.dir:
+            shutil.rmtree(site_dir)
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'corpus': corpus,
+        'params': params,
+        'makesite_args': args.makesite_args,
+        'generate': round(generate_time, 4),
+        'runs': runs,
+    }
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -34,12 +34,16 @@ import glob
 import sys
 import json
 import datetime
-import jinja2
+import time
 import copy
-from itertools import groupby
+import contextlib
+import functools
+import hashlib
+import pickle
+import io
+import itertools
 from collections.abc import Iterable
-from collections import defaultdict
-import pathlib
+from collections import defaultdict, ChainMap
 import urllib
 
 
@@ -49,16 +53,30 @@ def fread(filename):
         return f.read()
 
 
+def make_parent_dirs(filename):
+    """Create the folder of filename if it doesn't exist."""
+    basedir = os.path.dirname(filename)
+    if basedir:
+        os.makedirs(basedir, exist_ok=True)
+
+
 def fwrite(filename, text):
     """Write content to file and close the file."""
-    basedir = os.path.dirname(filename)
-    if not os.path.isdir(basedir):
-        os.makedirs(basedir)
+    make_parent_dirs(filename)
 
     with open(filename, 'w', encoding="utf-8") as f:
         f.write(text)
 
 
+def fwrite_pickle(filename, obj):
+    """Pickle obj to filename, replacing it only once it is fully written."""
+    make_parent_dirs(filename)
+    tmp_path = filename + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, filename)
+
+
 def log(msg, *args):
     """Log message with specified arguments."""
     sys.stderr.write(msg.format(*args) + '\n')
@@ -84,12 +102,71 @@ def rfc_2822_format(date_str):
 
 def read_content(filename, **params):
     """Read content and metadata from file into a dictionary."""
+    return parse_content(filename, fread(filename), True, **params)
+
+def read_metadata(filename, **params):
+    """Read only the metadata of a content file into a dictionary.
+
+    Returns what read_content() returns without the BODY_KEYS. Only the
+    headers at the start of the file are read, or the preface and
+    afterword of an AO3 work, and Markdown is not converted.
+    """
+    text = None
+    if filename.endswith('.html'):
+        text = read_ao3_metadata_text(filename)
+    if text is None:
+        text = read_header_text(filename)
+    return parse_content(filename, text, False, **params)
+
+# Keys of read_content()'s result that hold the text of a page.
+BODY_KEYS = ('content', 'chapters_content')
+
+def read_header_text(filename, size=4096):
+    """Read the start of a file up to the end of its headers."""
+    with open(filename, 'r', encoding="utf-8") as f:
+        text = ''
+        while True:
+            chunk = f.read(size)
+            text += chunk
+            end = 0
+            for key, val, end in read_headers(text):
+                pass
+            rest = text[end:].lstrip()
+            # Another header can only follow if the rest is the start of
+            # a comment that hasn't been read to its end yet.
+            if not chunk or not ('<!--'.startswith(rest) or rest.startswith('<!--') and '-->' not in rest):
+                return text
+            size *= 2
+
+def read_ao3_metadata_text(filename):
+    """Read the preface and afterword of an AO3 work without its chapters.
+
+    Returns None if the file is not an AO3 work, and the whole file if the
+    chapters can't be found.
+    """
+    import mmap
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            preface = m.find(b'<div id="preface">')
+            if preface == -1:
+                return None
+            chapters = m.find(b'<div id="chapters"', preface)
+            afterword = m.rfind(b'<div id="afterword">')
+            if chapters == -1 or afterword < chapters:
+                data = m[:]
+            else:
+                data = m[:chapters] + m[afterword:]
+    # Translate newlines as reading the file in text mode does.
+    return data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
 
-    log("Reading: " + filename)
-
-    # Read file content.
-    text = fread(filename)
+def parse_content(filename, text, body, **params):
+    """Read content and metadata from the text of a file into a dictionary.
 
+    If body is False, the text may be only the part of the file that
+    read_metadata() reads, and the BODY_KEYS are left out.
+    """
     # Read metadata and save it in a dictionary.
     date_slug = os.path.basename(filename).split('.')[0]
     match = re.search(r'^(?:(\d\d\d\d-\d\d-\d\d)-)?(.+)$', date_slug)
@@ -106,7 +183,7 @@ def read_content(filename, **params):
         try:
             if _test == 'ImportError':
                 raise ImportError('Error forced by test')
-            ao3_content, text = read_ao3_content(text, **params)
+            ao3_content, text = read_ao3_content(text, body, **params)
             content.update(**ao3_content)
             content["content_type"] = params.get('ao3_content_type', 'ao3_work')
         except ImportError as e:
@@ -124,7 +201,7 @@ def read_content(filename, **params):
             content['content_type'] = params.get('default_content_type', 'page')
 
         # Convert Markdown content to HTML.
-        if filename.endswith(('.md', '.mkd', '.mkdn', '.mdown', '.markdown')):
+        if body and filename.endswith(('.md', '.mkd', '.mkdn', '.mdown', '.markdown')):
             try:
                 if _test == 'ImportError':
                     raise ImportError('Error forced by test')
@@ -136,7 +213,8 @@ def read_content(filename, **params):
     from datetime import date
 
     # Update the dictionary with content and RFC 2822 date.
-    content['content'] = text
+    if body:
+        content['content'] = text
     if ( content.get('date') ):
         content.update({
             'rfc_2822_date': rfc_2822_format(content['date']),
@@ -145,80 +223,338 @@ def read_content(filename, **params):
 
     return content
 
-def read_ao3_content(text, **params):
+def read_ao3_content(text, body=True, **params):
+    """Read metadata and chapters from the HTML of an AO3 download."""
+    if params.get('build_options', {}).get('ao3_parser') == 'lxml':
+        try:
+            work = extract_ao3_lxml(text, body)
+        except (ImportError, ValueError) as e:
+            log('WARNING: Falling back to BeautifulSoup: {}', str(e))
+            work = extract_ao3_bs4(text, body)
+    else:
+        work = extract_ao3_bs4(text, body)
+    return process_ao3_work(work, **params)
+
+def extract_ao3_bs4(text, body=True):
+    """Extract the raw parts of an AO3 download with BeautifulSoup.
+
+    Returns a dictionary with the work's title, authors, the HTML of its
+    summary, notes and messages, its tags as (label, links, text) tuples
+    where links are (text, preceding text) pairs, and, unless body is
+    False, its text and chapters.
+    """
     from bs4 import BeautifulSoup
-    config = params.get("tag_processing")
-    content = {}
+    work = {}
     # soup = BeautifulSoup(text, 'html.parser')
     soup = BeautifulSoup(text, "lxml")
-    content['title']= soup.h1.get_text()
+    work['title'] = soup.h1.get_text()
     preface = soup.find('div', id='preface')
     meta = preface.find('div', class_="meta")
     tags = meta.find('dl', class_="tags")
     afterword = soup.find('div', id='afterword')
     authors = preface.find('div', class_="byline").find_all('a', rel="author")
-    content['author'] = list(map(lambda author: author.get_text(), authors))
+    work['author'] = list(map(lambda author: author.get_text(), authors))
     if ( summary_label := preface.find('p', string='Summary') ):
-        content['summary'] = summary_label.find_next('blockquote', class_="userstuff").decode_contents(formatter='minimal')
+        work['summary'] = summary_label.find_next('blockquote', class_="userstuff").decode_contents(formatter='minimal')
     if ( notes_label := preface.find('p', string='Notes') ):
-        content['notes'] = notes_label.find_next('blockquote', class_="userstuff").decode_contents(formatter='minimal')
+        work['notes'] = notes_label.find_next('blockquote', class_="userstuff").decode_contents(formatter='minimal')
     if ( end_notes_label := afterword.find('p', string='End Notes')):
-        content['end_notes'] = end_notes_label.find_next('blockquote', class_="userstuff").decode_contents(formatter='minimal')
+        work['end_notes'] = end_notes_label.find_next('blockquote', class_="userstuff").decode_contents(formatter='minimal')
     if ( top_message := preface.find('p', class_="message") ):
-        content['top_message'] = top_message.decode_contents(formatter='minimal')
+        work['top_message'] = top_message.decode_contents(formatter='minimal')
     if ( bottom_message := afterword.find('p', class_="message") ):
-        content['bottom_message'] = bottom_message.decode_contents(formatter='minimal')
+        work['bottom_message'] = bottom_message.decode_contents(formatter='minimal')
+    work['tags'] = []
     for tag in tags.find_all('dt'):
-        tag_name = tag.get_text().rstrip(':').casefold()
-        tag_val = tag.find_next("dd").find_all('a')
-        excluded_tags = [x.casefold() for x in config.get("excluded_tags", [])]
-        if (tag_val):
-            tag_val = merge_tags(tag_val, config.get("merge_tags", []))
-            tag_val = [ item for item in tag_val if not item.get_text().casefold() in excluded_tags]
+        dd = tag.find_next("dd")
+        links = [(link.get_text(), link.find_previous_sibling(string=True)) for link in dd.find_all('a')]
+        work['tags'].append((tag.get_text(), links, dd.get_text()))
+    if not body:
+        soup.decompose()
+        return work
+
+    chapters_div = soup.find(id='chapters', class_="userstuff")
+    work['text'] = chapters_div.decode_contents(formatter='minimal')
+    chapters = []
+    current_chapter = {}
+    for div in chapters_div.find_all('div', recursive=False):
+        css_class = div.get("class")
+        if "meta" in css_class:
+            if chapter_title := div.find('h2', class_="heading"):
+                if current_chapter: #If we find a chapter heading we should add the previous chapter to the list
+                    chapters.append(current_chapter)
+                    current_chapter = {}
+                current_chapter["title"] = chapter_title.get_text()
+            if chapter_summary_label := div.find('p', string="Chapter Summary"):
+                current_chapter["summary"] = chapter_summary_label.find_next_sibling('blockquote', class_="userstuff").decode_contents(formatter='minimal')
+            if chapter_notes_label := div.find('p', string="Chapter Notes"):
+                chapter_notes_content = chapter_notes_label.find_next_sibling('blockquote', class_="userstuff") 
+                if chapter_notes_content: #If the chapter only had an end note the script was grabbing the end notes here
+                    current_chapter["notes"] = chapter_notes_content.decode_contents(formatter='minimal')
+            if chapter_end_notes_label := div.find('p', string="Chapter End Notes"):
+                current_chapter["end_notes"] = chapter_end_notes_label.find_next_sibling('blockquote', class_="userstuff").decode_contents(formatter='minimal')
+        elif "userstuff" in css_class:
+                current_chapter["content"] = div.decode_contents(formatter='minimal')
+        else:
+            continue
+    if current_chapter: #Make sure last  chapter is added
+        chapters.append(current_chapter)   
+    work['chapters'] = chapters
+    soup.decompose()
+    return work
+
+# How BeautifulSoup's HTML tree builder and 'minimal' formatter treat
+# elements, so that extract_ao3_lxml() can serialize HTML identically.
+BS4_VOID_TAGS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen',
+    'link', 'menuitem', 'meta', 'param', 'source', 'track', 'wbr',
+    'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex', 'nextid',
+    'spacer'])
+BS4_STRING_CONTAINERS = frozenset(['rt', 'rp', 'style', 'script', 'template'])
+BS4_RAW_TEXT_TAGS = frozenset(['script', 'style'])
+BS4_PRESERVE_WHITESPACE_TAGS = frozenset(['pre', 'textarea'])
+BS4_ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+BS4_LIST_ATTRIBUTES = {
+    '*': frozenset(['class', 'accesskey', 'dropzone']),
+    'a': frozenset(['rel', 'rev']),
+    'link': frozenset(['rel', 'rev']),
+    'td': frozenset(['headers']),
+    'th': frozenset(['headers']),
+    'form': frozenset(['accept-charset']),
+    'object': frozenset(['archive']),
+    'area': frozenset(['rel']),
+    'icon': frozenset(['sizes']),
+    'iframe': frozenset(['sandbox']),
+    'output': frozenset(['for']),
+}
+
+def has_class(name):
+    """Return an XPath predicate matching elements with a CSS class."""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+def xpath_first(element, path, what):
+    """Return the first XPath match, raising ValueError if there is none."""
+    found = element.xpath(path)
+    if not found:
+        raise ValueError(f'No {what} found')
+    return found[0]
+
+def bs4_string(text, preserve=False):
+    """Collapse whitespace-only strings the way BeautifulSoup does."""
+    if preserve or text.strip(BS4_ASCII_SPACES):
+        return text
+    return '\n' if '\n' in text else ' '
+
+def preserves_whitespace(element):
+    """Return True if element is inside a pre or textarea element."""
+    return any(e.tag in BS4_PRESERVE_WHITESPACE_TAGS
+               for e in itertools.chain([element], element.iterancestors()))
+
+def lxml_text(element, preserve=None):
+    """Return the text of an lxml element like bs4's get_text()."""
+    if preserve is None:
+        preserve = preserves_whitespace(element)
+    parts = []
+    if element.text:
+        parts.append(bs4_string(element.text, preserve))
+    for child in element:
+        if isinstance(child.tag, str) and child.tag not in BS4_STRING_CONTAINERS:
+            parts.append(lxml_text(child, preserve or child.tag in BS4_PRESERVE_WHITESPACE_TAGS))
+        if child.tail:
+            parts.append(bs4_string(child.tail, preserve))
+    return ''.join(parts)
+
+def lxml_string(element):
+    """Return an element's only string like bs4's Tag.string, or None."""
+    if element.text:
+        return None if len(element) else bs4_string(element.text, preserves_whitespace(element))
+    if len(element) != 1 or element[0].tail:
+        return None
+    child = element[0]
+    return lxml_string(child) if isinstance(child.tag, str) else child.text
+
+def lxml_previous_string(element):
+    """Return the nearest preceding sibling string like bs4's find_previous_sibling(string=True)."""
+    preserve = preserves_whitespace(element.getparent())
+    sibling = element.getprevious()
+    while sibling is not None:
+        if sibling.tail:
+            return bs4_string(sibling.tail, preserve)
+        if not isinstance(sibling.tag, str):
+            return sibling.text
+        sibling = sibling.getprevious()
+    text = element.getparent().text
+    return bs4_string(text, preserve) if text else None
+
+def lxml_find_labelled(element, label):
+    """Return the first p element in element whose only string is label."""
+    for p in element.iter('p'):
+        if lxml_string(p) == label:
+            return p
+    return None
+
+def escape_bs4(text):
+    """Escape text like bs4's 'minimal' formatter."""
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def lxml_inner_html(element):
+    """Serialize an element's contents like bs4's decode_contents(formatter='minimal')."""
+    parts = []
+    lxml_serialize_contents(element, parts, preserves_whitespace(element))
+    return ''.join(parts)
+
+def lxml_serialize_contents(element, parts, preserve):
+    raw = element.tag in BS4_RAW_TEXT_TAGS
+    if element.text:
+        text = bs4_string(element.text, preserve)
+        parts.append(text if raw else escape_bs4(text))
+    for child in element:
+        tag = child.tag
+        if isinstance(tag, str):
+            parts.append('<' + tag)
+            list_attributes = BS4_LIST_ATTRIBUTES.get(tag, frozenset()) | BS4_LIST_ATTRIBUTES['*']
+            for name, value in sorted(child.attrib.items()):
+                if name in list_attributes:
+                    value = ' '.join(value.split())
+                value = escape_bs4(value)
+                if '"' not in value:
+                    parts.append(f' {name}="{value}"')
+                elif "'" not in value:
+                    parts.append(f" {name}='{value}'")
+                else:
+                    parts.append(' {}="{}"'.format(name, value.replace('"', '&quot;')))
+            if tag in BS4_VOID_TAGS and not len(child) and not child.text:
+                parts.append('/>')
+            else:
+                parts.append('>')
+                lxml_serialize_contents(child, parts, preserve or tag in BS4_PRESERVE_WHITESPACE_TAGS)
+                parts.append('</' + tag + '>')
+        elif tag.__name__ == 'Comment':
+            parts.append('<!--' + child.text + '-->')
+        else:
+            parts.append('<?' + child.target + ' ' + (child.text or '') + '>')
+        if child.tail:
+            text = bs4_string(child.tail, preserve)
+            parts.append(text if raw else escape_bs4(text))
+
+def extract_ao3_lxml(text, body=True):
+    """Extract the raw parts of an AO3 download with lxml.
+
+    Uses XPath over the fixed structure of AO3 downloads instead of a
+    BeautifulSoup tree, and returns the same dictionary as
+    extract_ao3_bs4(). Raises ValueError if the document doesn't have the
+    expected structure.
+    """
+    from lxml import etree
+    # lxml's tree drops namespace prefixes such as <o:p>, BeautifulSoup
+    # keeps them.
+    if re.search(r'<[A-Za-z][\w.-]*:[A-Za-z]', text):
+        raise ValueError('Document contains prefixed tag names')
+    root = etree.fromstring(text, etree.HTMLParser())
+    if root is None:
+        raise ValueError('Empty document')
+    work = {}
+    work['title'] = lxml_text(xpath_first(root, '//h1', 'title'))
+    preface = xpath_first(root, "//div[@id='preface']", 'preface')
+    meta = xpath_first(preface, f".//div[{has_class('meta')}]", 'meta')
+    tags = xpath_first(meta, f".//dl[{has_class('tags')}]", 'tags')
+    afterword = xpath_first(root, "//div[@id='afterword']", 'afterword')
+    byline = xpath_first(preface, f".//div[{has_class('byline')}]", 'byline')
+    work['author'] = [lxml_text(a) for a in byline.xpath(
+        ".//a[contains(concat(' ', normalize-space(@rel), ' '), ' author ')]")]
+
+    next_userstuff = f"(descendant::blockquote[{has_class('userstuff')}] | following::blockquote[{has_class('userstuff')}])[1]"
+    for key, element, label in (('summary', preface, 'Summary'),
+                                ('notes', preface, 'Notes'),
+                                ('end_notes', afterword, 'End Notes')):
+        if (p := lxml_find_labelled(element, label)) is not None:
+            work[key] = lxml_inner_html(xpath_first(p, next_userstuff, label))
+    for key, element in (('top_message', preface), ('bottom_message', afterword)):
+        if message := element.xpath(f".//p[{has_class('message')}]"):
+            work[key] = lxml_inner_html(message[0])
+
+    work['tags'] = []
+    for dt in tags.iter('dt'):
+        dd = xpath_first(dt, '(descendant::dd | following::dd)[1]', 'tag values')
+        links = [(lxml_text(a), lxml_previous_string(a)) for a in dd.iter('a')]
+        work['tags'].append((lxml_text(dt), links, lxml_text(dd)))
+    if not body:
+        return work
+
+    chapters_div = xpath_first(root, f"//*[@id='chapters'][{has_class('userstuff')}]", 'chapters')
+    work['text'] = lxml_inner_html(chapters_div)
+    next_sibling_userstuff = f"following-sibling::blockquote[{has_class('userstuff')}][1]"
+    chapters = []
+    current_chapter = {}
+    for div in chapters_div.iterchildren('div'):
+        css_class = (div.get('class') or '').split()
+        if 'meta' in css_class:
+            if chapter_title := div.xpath(f".//h2[{has_class('heading')}]"):
+                if current_chapter:
+                    chapters.append(current_chapter)
+                    current_chapter = {}
+                current_chapter['title'] = lxml_text(chapter_title[0])
+            if (label := lxml_find_labelled(div, 'Chapter Summary')) is not None:
+                current_chapter['summary'] = lxml_inner_html(xpath_first(label, next_sibling_userstuff, 'chapter summary'))
+            if (label := lxml_find_labelled(div, 'Chapter Notes')) is not None:
+                if notes := label.xpath(next_sibling_userstuff):
+                    current_chapter['notes'] = lxml_inner_html(notes[0])
+            if (label := lxml_find_labelled(div, 'Chapter End Notes')) is not None:
+                current_chapter['end_notes'] = lxml_inner_html(xpath_first(label, next_sibling_userstuff, 'chapter end notes'))
+        elif 'userstuff' in css_class:
+            current_chapter['content'] = lxml_inner_html(div)
+    if current_chapter:
+        chapters.append(current_chapter)
+    work['chapters'] = chapters
+    return work
+
+def process_ao3_work(work, **params):
+    """Build the content dictionary of an AO3 work from its raw parts."""
+    config = params.get("tag_processing")
+    rules = tag_rules(params)
+    content = {}
+    for key in ('title', 'author', 'summary', 'notes', 'end_notes', 'top_message', 'bottom_message'):
+        if key in work:
+            content[key] = work[key]
+    excluded_tags = rules.excluded_tags
+    for tag_label, links, tag_text in work['tags']:
+        tag_name = tag_label.rstrip(':').casefold()
+        if links:
             if "series" == tag_name:
                 series = []
-                for link in tag_val:
-                    series_index = re.search(r'\d+', link.find_previous_sibling(string=True)) or 0
+                for link_text, previous_text in links:
+                    if link_text.casefold() in excluded_tags:
+                        continue
+                    series_index = re.search(r'\d+', previous_text) or 0
                     if series_index:
                         series_index = series_index.group()
-                    series_title = link.get_text().strip()
-                    if not series_title in config.get("exclude_series", []):
+                    series_title = link_text.strip()
+                    if not series_title in rules.excluded_series:
                         series.append({ "index": series_index, "title": series_title })
                 tag_val = series
-            elif "additional tags" == tag_name:
-                filtered_tags = []
-                media_tags = config.get("media_tags", [])
-                for freeform_tag in tag_val:
-                    tag_text = freeform_tag.get_text()
-                    try: # Use the version of the media tag in the params for formatting
-                        media_tag_index = [x.casefold() for x in media_tags].index(tag_text.casefold())
-                        media_tag = media_tags[media_tag_index]
-                        if content.get("media_type"):
-                            content["media_type"].append(media_tag)
-                        else:
-                            content["media_type"] = [ media_tag ]
-                    except ValueError:                        
-                        filtered_tags.append(tag_text)
-                tag_val = filtered_tags
             else:
-                tag_val = list(map(lambda val: val.get_text(), tag_val))
+                tag_val = rules.merge([link_text for link_text, previous_text in links])
+                tag_val = [ item for item in tag_val if not item.casefold() in excluded_tags]
+                if "additional tags" == tag_name:
+                    filtered_tags = []
+                    for tag_text in tag_val:
+                        # Use the version of the media tag in the params for formatting
+                        if media_tag := rules.media_tags.get(tag_text.casefold()):
+                            if content.get("media_type"):
+                                content["media_type"].append(media_tag)
+                            else:
+                                content["media_type"] = [ media_tag ]
+                        else:
+                            filtered_tags.append(tag_text)
+                    tag_val = filtered_tags
         else:
-            tag_val = tag.find_next("dd").get_text()
+            tag_val = tag_text
             if tag_val.casefold() in excluded_tags: continue
         if merge_fieldnames := params.get("merge_fieldnames", False):
             if tag_name in merge_fieldnames.keys():
                 tag_name = merge_fieldnames[tag_name]
         content[tag_name] = tag_val
 
-    for fields in afterword.find_all('dt'):
-        field_name = tag.get_text().rstrip(':')
-        field_val = tag.find_next("dd").find_all('a')
-        if (field_val):
-            if "Works inspired by this one" == field_name:
-                content["related_works"] = tag_val
-            else:
-                content[tag_name] = tag_val
-
     if "media_tags" in config and not content.get("media_type"):
         content["media_type"] = config.get("media_type_default")
 
@@ -233,53 +569,1066 @@ def read_ao3_content(text, **params):
     content = { k.casefold().replace(' ', '_').replace('\'"', ''): v for k, v in content.items() }
 
     if "words" in content:
-        import locale
-        locale.setlocale(locale.LC_ALL, '')
-        content['words'] = locale.atoi(content['words'])
-    chapters_div = soup.find(id='chapters', class_="userstuff")
-    text = chapters_div.decode_contents(formatter='minimal')
-    chapters = []
-    current_chapter = {}
-    for div in chapters_div.find_all('div', recursive=False):
-        css_class = div.get("class")
-        if "meta" in css_class:
-            if chapter_title := div.find('h2', class_="heading"):
-                if current_chapter: #If we find a chapter heading we should add the previous chapter to the list
-                    chapters.append(current_chapter)
-                    current_chapter = {}
-                current_chapter["title"] = chapter_title.get_text()
-            if chapter_summary_label := div.find('p', string="Chapter Summary"):
-                current_chapter["summary"] = chapter_summary_label.find_next_sibling('blockquote', class_="userstuff").decode_contents(formatter='minimal')
-            if chapter_notes_label := div.find('p', string="Chapter Notes"):
-                chapter_notes_content = chapter_notes_label.find_next_sibling('blockquote', class_="userstuff") 
-                if chapter_notes_content: #If the chapter only had an end note the script was grabbing the end notes here
-                    current_chapter["notes"] = chapter_notes_content.decode_contents(formatter='minimal')
-            if chapter_end_notes_label := div.find('p', string="Chapter End Notes"):
-                current_chapter["end_notes"] = chapter_end_notes_label.find_next_sibling('blockquote', class_="userstuff").decode_contents(formatter='minimal')
-        elif "userstuff" in css_class:
-                current_chapter["content"] = div.decode_contents(formatter='minimal')
-        else:
-            continue
-    if current_chapter: #Make sure last  chapter is added
-        chapters.append(current_chapter)   
-    content["chapters_content"] = list(chapters) 
-    soup.decompose()
+        # Word counts use a thousands separator, which depends on the
+        # language of the download rather than the locale we run in.
+        content['words'] = int(re.sub(r'[^0-9]', '', content['words']))
+    if 'chapters' in work:
+        content["chapters_content"] = list(work['chapters'])
 
-    return content, text
+    return content, work.get('text')
 
 def merge_tags( tags, merge_list ):
-    output_tags = []
-    for tag in tags:
-        merged = False
-        for merge in merge_list:
-            merge_to = merge[0]
-            if tag in merge:
-                merged = True
-                if not merge_to in output_tags:
-                    output_tags.append(merge_to)
-        if not merged:
-            output_tags.append(tag)
-    return output_tags
+    return TagRules({'merge_tags': merge_list}).merge(tags)
+
+class TagRules:
+    """The tag_processing options compiled into sets and dictionaries.
+
+    load_params() compiles them once into params['tag_rules'], so that
+    reading a work or grouping a list looks each tag up instead of going
+    through every rule.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.excluded_tags = {tag.casefold() for tag in config.get('excluded_tags', [])}
+        self.excluded_series = set(config.get('exclude_series', []))
+        # Tag -> the tags it is merged into, in the order of merge_tags.
+        self.merge_targets = {}
+        for merge in config.get('merge_tags', []):
+            for tag in dict.fromkeys(merge):
+                self.merge_targets.setdefault(tag, []).append(merge[0])
+        # Casefolded media tag -> the media tag as it is written in the params.
+        self.media_tags = {}
+        for tag in config.get('media_tags', []):
+            self.media_tags.setdefault(tag.casefold(), tag)
+        # Fandom -> the groups it is in, in the order of fandom_groups.
+        self.fandom_groups = {}
+        for grouping in config.get('fandom_groups', []):
+            for fandom in dict.fromkeys(grouping):
+                self.fandom_groups.setdefault(fandom, []).append(grouping[0])
+
+    def merge(self, tags):
+        """Replace tags that are in a merge_tags list with the first tag of the list."""
+        output_tags = []
+        merged = set()
+        for tag in tags:
+            if targets := self.merge_targets.get(tag):
+                for merge_to in targets:
+                    if merge_to not in merged:
+                        merged.add(merge_to)
+                        output_tags.append(merge_to)
+            else:
+                output_tags.append(tag)
+        return output_tags
+
+def tag_rules(params):
+    """Return the compiled tag_processing options of params."""
+    return params.get('tag_rules') or TagRules(params.get('tag_processing') or {})
+
+# Bump this whenever read_content() starts producing different output so
+# that existing parse caches are discarded.
+PARSE_CACHE_VERSION = 3
+
+# Params that change what read_content() returns for the same file.
+PARSE_PARAMS = ('tag_processing', 'merge_fieldnames',
+                'replace_spaces_in_filename_with', 'ao3_content_type',
+                'content_type', 'default_content_type')
+
+def file_digest(filename):
+    """Return the md5 hex digest of a file's bytes."""
+    with open(filename, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+def parse_fingerprint(params):
+    """Return a digest of the params that affect read_content()."""
+    relevant = {key: params.get(key) for key in PARSE_PARAMS}
+    relevant['ao3_parser'] = params.get('build_options', {}).get('ao3_parser')
+    text = json.dumps(relevant, sort_keys=True, default=str)
+    return hashlib.md5(text.encode()).hexdigest()
+
+class ParseCache:
+    """On-disk cache of read_content() results, keyed by source path.
+
+    An entry is reused when the parse params fingerprint matches and either
+    the file's mtime and size are unchanged or its content hash still
+    matches. Entries whose sources were not read during the build are
+    evicted when the cache is saved.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.used = set()
+        self.changed = False
+        if os.path.isfile(path):
+            try:
+                with open(path, 'rb') as f:
+                    cache = pickle.load(f)
+                if cache.get('version') == PARSE_CACHE_VERSION:
+                    self.entries = cache['entries']
+            except Exception as e:
+                log('WARNING: Ignoring unreadable cache {}: {}', path, str(e))
+
+    def lookup(self, filename, **params):
+        """Return (content, key) where content is None on a cache miss.
+
+        The key must be passed back to store() together with the parsed
+        content so the entry records the file state from before parsing.
+        """
+        entry, key = self.find(filename, params)
+        if entry is None:
+            return None, key
+        content = pickle.loads(entry['content'])
+        content.update(pickle.loads(entry['body']))
+        return content, None
+
+    def lookup_metadata(self, filename, **params):
+        """Like lookup(), but return the content without its BODY_KEYS."""
+        entry, key = self.find(filename, params)
+        if entry is None:
+            return None, key
+        return pickle.loads(entry['content']), None
+
+    def find(self, filename, params):
+        """Return (entry, key) where entry is None on a cache miss."""
+        self.used.add(filename)
+        stat = os.stat(filename)
+        fingerprint = parse_fingerprint(params)
+        entry = self.entries.get(filename)
+        if entry and entry['fingerprint'] == fingerprint:
+            if (entry['mtime'], entry['size']) == (stat.st_mtime_ns, stat.st_size):
+                return entry, None
+            digest = file_digest(filename)
+            if entry['digest'] == digest:
+                entry['mtime'], entry['size'] = stat.st_mtime_ns, stat.st_size
+                self.changed = True
+                return entry, None
+        else:
+            digest = file_digest(filename)
+        return None, (stat.st_mtime_ns, stat.st_size, digest, fingerprint)
+
+    def store(self, filename, key, content):
+        """Record parsed content for filename."""
+        mtime, size, digest, fingerprint = key
+        # The text is kept apart so that lookup_metadata() doesn't load it.
+        metadata = {key: value for key, value in content.items() if key not in BODY_KEYS}
+        body = {key: content[key] for key in BODY_KEYS if key in content}
+        self.entries[filename] = {
+            'mtime': mtime,
+            'size': size,
+            'digest': digest,
+            'fingerprint': fingerprint,
+            'content': pickle.dumps(metadata, pickle.HIGHEST_PROTOCOL),
+            'body': pickle.dumps(body, pickle.HIGHEST_PROTOCOL),
+        }
+        self.changed = True
+
+    def save(self):
+        """Evict stale entries and write the cache to disk."""
+        stale = self.entries.keys() - self.used
+        for filename in stale:
+            del self.entries[filename]
+        if not (self.changed or stale):
+            return
+        fwrite_pickle(self.path, {'version': PARSE_CACHE_VERSION, 'entries': self.entries})
+
+def template_source(template_env, name):
+    """Return the source of a template, or None if the loader can't provide it."""
+    import jinja2
+    loader = template_env.loader
+    for loader in getattr(loader, 'loaders', [loader]):
+        try:
+            return loader.get_source(template_env, name)[0]
+        except (jinja2.TemplateNotFound, RuntimeError, TypeError):
+            continue
+    return None
+
+# Bump this whenever the entries of the summary and render caches change
+# so that existing caches are discarded.
+RENDER_CACHE_VERSION = 1
+
+# The number of pages the render cache remembers by default.
+RENDER_CACHE_SIZE = 10000
+
+def template_chain(template):
+    """Return the templates a template is made of, or None if unknown.
+
+    That is a (name, source, ast) tuple for the template and for every
+    template it includes, imports or extends, directly or not.
+    """
+    from jinja2 import meta
+    env = template.environment
+    chain = []
+    names, seen = [template.name], set()
+    while names:
+        name = names.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        source = template_source(env, name) if name else None
+        if source is None:
+            return None
+        ast = env.parse(source)
+        chain.append((name, source, ast))
+        names.extend(meta.find_referenced_templates(ast))
+    return chain
+
+class TemplateCache:
+    """Base class of the caches of rendered templates.
+
+    A template's key covers its source and the sources of the templates it
+    includes, imports or extends, and the value of every variable they
+    use, see key().
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.used = set()
+        self.changed = False
+        self.templates = {}
+        if path and os.path.isfile(path):
+            try:
+                with open(path, 'rb') as f:
+                    cache = pickle.load(f)
+                if cache.get('version') == RENDER_CACHE_VERSION:
+                    self.entries = cache['entries']
+            except Exception as e:
+                log('WARNING: Ignoring unreadable cache {}: {}', path, str(e))
+
+    def template_key(self, template):
+        """Return the digest and variables of a template, or None if unknown."""
+        if template.name not in self.templates:
+            from jinja2 import meta
+            chain = template_chain(template)
+            if chain is None:
+                # Can't tell what the template depends on.
+                self.templates[template.name] = None
+                return None
+            digest = hashlib.md5()
+            variables = set()
+            for name, source, ast in chain:
+                digest.update(name.encode() + b'\0' + source.encode())
+                variables |= meta.find_undeclared_variables(ast)
+            self.templates[template.name] = (digest.hexdigest(), sorted(variables))
+        return self.templates[template.name]
+
+    def key(self, template, params, *extra):
+        """Return the key of template rendered with params, or None if unknown."""
+        template_key = self.template_key(template)
+        if template_key is None:
+            return None
+        digest, variables = template_key
+        values = json.dumps([digest, [params.get(name) for name in variables], *extra],
+                            sort_keys=True, default=str)
+        return hashlib.md5(values.encode()).hexdigest()
+
+    def evict(self):
+        """Drop the entries that should not be saved; return True if any were."""
+        return False
+
+    def save(self):
+        """Evict stale entries and write the cache to disk."""
+        if not self.path:
+            return
+        stale = self.evict()
+        if not (self.changed or stale):
+            return
+        fwrite_pickle(self.path, {'version': RENDER_CACHE_VERSION, 'entries': self.entries})
+
+class SummaryCache(TemplateCache):
+    """Rendered summaries, keyed by the template and the values it uses.
+
+    Each summary is rendered once however many lists include it, and if
+    the cache has a path, only once across builds until the work or the
+    template changes.
+    """
+
+    def render(self, template, params):
+        """Return template rendered with params, rendering it only once."""
+        key = self.key(template, params)
+        if key is None:
+            return template.render(**params)
+        self.used.add(key)
+        if key not in self.entries:
+            self.entries[key] = template.render(**params)
+            self.changed = True
+        return self.entries[key]
+
+    def evict(self):
+        """Drop the summaries that were not used in this build."""
+        stale = self.entries.keys() - self.used
+        for key in stale:
+            del self.entries[key]
+        return bool(stale)
+
+class RenderCache(TemplateCache):
+    """Digests of rendered pages, keyed by the template and the values it uses.
+
+    The output of a page is not stored: a page whose key is in the cache
+    and whose output file still has the digest recorded in the output
+    manifest doesn't have to be rendered or written again. Only the size
+    most recently used keys are kept.
+    """
+
+    def __init__(self, path=None, size=RENDER_CACHE_SIZE):
+        super().__init__(path)
+        self.size = size
+
+    def lookup(self, key):
+        """Return the (digest, size) of the output rendered for key, or None."""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            # Move it to the end, the most recently used.
+            self.entries[key] = entry
+            self.changed = True
+        return entry
+
+    def store(self, key, digest, size):
+        """Record the digest and size of the output rendered for key."""
+        self.entries.pop(key, None)
+        self.entries[key] = (digest, size)
+        self.changed = True
+        self.evict()
+
+    def evict(self):
+        """Drop the least recently used keys beyond the cache's size."""
+        stale = list(itertools.islice(self.entries, max(len(self.entries) - self.size, 0)))
+        for key in stale:
+            del self.entries[key]
+        return bool(stale)
+
+class OutputManifest:
+    """Record of the path, size and digest of every file in the output.
+
+    Writes whose digest matches the previous build's entry are skipped if
+    the file is still there, so unchanged outputs keep their mtimes, and
+    outputs from the previous build that were not produced again can be
+    removed.
+    """
+
+    def __init__(self, path, site_dir):
+        self.path = path
+        self.site_dir = site_dir
+        self.previous = {}
+        self.current = {}
+        # What the outputs were generated from, see depend().
+        self.templates = {}
+        self.content = None
+        self.params = None
+        if os.path.isfile(path):
+            try:
+                manifest = json.loads(fread(path))
+                if manifest.get('site_dir') == site_dir:
+                    self.previous = manifest['files']
+                    self.templates = manifest.get('templates', {})
+                    if manifest.get('content') is not None:
+                        self.content = {path: stat and tuple(stat) for path, stat in manifest['content'].items()}
+                    self.params = manifest.get('params')
+            except (ValueError, KeyError) as e:
+                log('WARNING: Ignoring unreadable manifest {}: {}', path, str(e))
+
+    def key(self, filename):
+        """Return the manifest key for an output path."""
+        return os.path.relpath(filename, self.site_dir).replace(os.sep, '/')
+
+    def unchanged(self, filename, digest, size):
+        """Return True if filename already holds the expected bytes."""
+        entry = self.previous.get(self.key(filename))
+        if not entry or entry['digest'] != digest:
+            return False
+        try:
+            return os.path.getsize(filename) == size
+        except OSError:
+            return False
+
+    def write(self, filename, data, digest=None):
+        """Write bytes to filename unless it is unchanged; return True if written."""
+        digest = digest or hashlib.md5(data).hexdigest()
+        self.current[self.key(filename)] = {'size': len(data), 'digest': digest}
+        if self.unchanged(filename, digest, len(data)):
+            return False
+        make_parent_dirs(filename)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return True
+
+    def replace(self, filename, tmp_path, digest, size):
+        """Move a file written to tmp_path to filename unless it is unchanged.
+
+        Returns True if filename was replaced.
+        """
+        self.current[self.key(filename)] = {'size': size, 'digest': digest}
+        if self.unchanged(filename, digest, size):
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, filename)
+        return True
+
+    def keep(self, filename):
+        """Keep the previous entry for a file that was not written again."""
+        key = self.key(filename)
+        if key in self.previous:
+            self.current[key] = self.previous[key]
+
+    def merge(self, other):
+        """Add the outputs recorded by the previous build of other, e.g. a shard."""
+        self.current.update(other.previous)
+        self.templates.update(other.templates)
+        if other.content is not None:
+            self.content, self.params = other.content, other.params
+
+    def depend(self, filename, templates, sources, page=None):
+        """Record what an output that was written or kept was generated from.
+
+        templates is a list of the (name, digest) of every template used,
+        or None if they are unknown, sources the content files the output
+        shows, and page the content file of a page's outputs.
+        """
+        entry = self.current.get(self.key(filename))
+        if entry is None:
+            return
+        entry = self.current[self.key(filename)] = dict(entry, sources=sorted(set(sources)))
+        if templates is None:
+            entry['templates'] = None
+        else:
+            entry['templates'] = sorted({name for name, digest in templates})
+            self.templates.update(templates)
+        if page:
+            entry['page'] = page
+
+    def dependents(self, templates=(), sources=(), previous=False):
+        """Return the outputs generated from any of templates or sources.
+
+        The outputs of the build being recorded are searched, or of the
+        previous build if previous is True. Returns a dict of the outputs'
+        keys and entries.
+        """
+        templates, sources = set(templates), set(sources)
+        found = {}
+        for key, entry in (self.previous if previous else self.current).items():
+            if 'sources' not in entry:
+                continue
+            used = entry['templates']
+            if (used is None and templates or templates.intersection(used or ())
+                    or sources.intersection(entry['sources'])):
+                found[key] = entry
+        return found
+
+    def page_outputs(self):
+        """Return the outputs of each page of the previous build."""
+        outputs = defaultdict(list)
+        for key, entry in sorted(self.previous.items()):
+            if entry.get('page'):
+                outputs[entry['page']].append(os.path.join(self.site_dir, *key.split('/')))
+        return dict(outputs)
+
+    def copy_tree(self, src_dir, dst_dir):
+        """Copy new or changed files from src_dir into dst_dir."""
+        for dirpath, dirnames, filenames in os.walk(src_dir):
+            for filename in filenames:
+                src_path = os.path.join(dirpath, filename)
+                dst_path = os.path.join(dst_dir, os.path.relpath(src_path, src_dir))
+                digest = file_digest(src_path)
+                size = os.path.getsize(src_path)
+                self.current[self.key(dst_path)] = {'size': size, 'digest': digest}
+                if not self.unchanged(dst_path, digest, size):
+                    make_parent_dirs(dst_path)
+                    shutil.copy2(src_path, dst_path)
+
+    def remove_stale(self):
+        """Delete outputs of the previous build that were not written again."""
+        for key in sorted(self.previous.keys() - self.current.keys()):
+            filename = os.path.join(self.site_dir, *key.split('/'))
+            if os.path.isfile(filename):
+                log('Removing {} ...', filename)
+                os.remove(filename)
+            # Clean up directories left empty, stopping at the site root.
+            dirname = os.path.dirname(filename)
+            while (os.path.normpath(dirname) != os.path.normpath(self.site_dir)
+                   and os.path.isdir(dirname) and not os.listdir(dirname)):
+                os.rmdir(dirname)
+                dirname = os.path.dirname(dirname)
+
+    def restart(self, dropped=None):
+        """Start recording a new build over the outputs of this one.
+
+        By default every output has to be written again to be kept. If
+        dropped is given, the outputs of this build are carried over except
+        for the files in dropped.
+        """
+        self.previous = self.current
+        self.current = {}
+        if dropped is not None:
+            dropped = {self.key(filename) for filename in dropped}
+            self.current = {key: entry for key, entry in self.previous.items()
+                            if key not in dropped}
+
+    def save(self):
+        """Write the manifest of this build to disk."""
+        manifest = {'site_dir': self.site_dir, 'files': self.current,
+                    'templates': self.templates, 'content': self.content, 'params': self.params}
+        fwrite(self.path, json.dumps(manifest, indent=1, sort_keys=True))
+
+def write_deploy_manifest(manifest, deploy_dir):
+    """Write the outputs of a build and what changed since the last build to deploy_dir.
+
+    manifest.json has the path, size and md5 of every file in the output
+    folder, and changes.json the paths that were added, changed or
+    removed since the manifest.json that was in deploy_dir before.
+    """
+    path = os.path.join(deploy_dir, 'manifest.json')
+    previous = {}
+    if os.path.isfile(path):
+        try:
+            previous = json.loads(fread(path))['files']
+        except (ValueError, KeyError) as e:
+            log('WARNING: Ignoring unreadable deploy manifest {}: {}', path, str(e))
+    files = {key: {'size': entry['size'], 'digest': entry['digest']}
+             for key, entry in manifest.current.items()}
+    changes = {
+        'added': sorted(files.keys() - previous.keys()),
+        'changed': sorted(key for key in files.keys() & previous.keys() if files[key] != previous[key]),
+        'removed': sorted(previous.keys() - files.keys()),
+    }
+    fwrite(os.path.join(deploy_dir, 'changes.json'), json.dumps(changes, indent=1))
+    fwrite(path, json.dumps({'site_dir': manifest.site_dir, 'files': files}, indent=1, sort_keys=True))
+    log('Deploy: {} added, {} changed, {} removed',
+        len(changes['added']), len(changes['changed']), len(changes['removed']))
+    return changes
+
+# The value of an href or src attribute in HTML.
+LINK_PATTERN = re.compile(rb'''\s(?:href|src)\s*=\s*(?:"([^"]*)"|'([^']*)')''', re.IGNORECASE)
+
+def check_links(manifest, base_path='/'):
+    """Return the internal links of the HTML files in the output that are broken.
+
+    Every output recorded in manifest is a valid target, as is the folder
+    of an index.html file. Each HTML output is read once and the href and
+    src values that are not absolute URLs are resolved against its URI and
+    looked up. Links outside of base_path are not checked. Returns a dict
+    of the content file of each page with broken links, or the output path
+    of lists and static files, to the sorted list of its broken links.
+    """
+    import html
+    prefix = base_path.rstrip('/')
+    targets = set()
+    for key in manifest.current:
+        targets.add('/' + key)
+        if key == 'index.html' or key.endswith('/index.html'):
+            folder = '/' + key[:-len('index.html')]
+            targets.update((folder, folder.rstrip('/')))
+
+    def broken_link(uri, value):
+        """Return the link in an attribute value if it is internal and broken."""
+        link = html.unescape(value.decode('utf-8', 'replace')).strip()
+        if not link or link.startswith(('#', '//')) or re.match(r'[a-zA-Z][a-zA-Z0-9+.-]*:', link):
+            return None
+        path = urllib.parse.unquote(urllib.parse.urlsplit(urllib.parse.urljoin(uri, link)).path)
+        if path != prefix and not path.startswith(prefix + '/'):
+            return None
+        return link if (path[len(prefix):] or '/') not in targets else None
+
+    # Most links, like those of menus, are the same on every page.
+    results = {}
+    broken = defaultdict(set)
+    for key, entry in manifest.current.items():
+        if not key.endswith(('.html', '.htm')):
+            continue
+        try:
+            with open(os.path.join(manifest.site_dir, key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            continue
+        uri = prefix + '/' + key
+        for match in LINK_PATTERN.finditer(data):
+            value = match.group(1) if match.group(1) is not None else match.group(2)
+            cache_key = (None if value.startswith(b'/') else uri, value)
+            if cache_key not in results:
+                results[cache_key] = broken_link(uri, value)
+            if results[cache_key]:
+                broken[entry.get('page') or key].add(results[cache_key])
+    for source, links in sorted(broken.items()):
+        log('Broken links in {}: {}', source, ', '.join(sorted(links)))
+    if broken:
+        log('{} files have broken links', len(broken))
+    return {source: sorted(links) for source, links in broken.items()}
+
+def read_content_captured(filename, params, body=True):
+    """Read content and return it with anything logged while reading it.
+
+    Used by worker processes so that their log output can be replayed in
+    file order by the parent process. The content and log output are
+    followed by the process id, start time and duration of the read, for
+    the profiler. If body is False, only the metadata is read.
+    """
+    stderr, sys.stderr = sys.stderr, io.StringIO()
+    start = time.perf_counter()
+    try:
+        content = read_content(filename, **params) if body else read_metadata(filename, **params)
+        return content, sys.stderr.getvalue(), (os.getpid(), start, time.perf_counter() - start)
+    finally:
+        sys.stderr = stderr
+
+class Profiler:
+    """Timings of the phases, files and templates of a build.
+
+    Saved in the Chrome trace event format, which chrome://tracing and
+    https://ui.perfetto.dev can display.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.pid = os.getpid()
+        self.start = time.perf_counter()
+
+    def add(self, name, category, start, duration, pid=None, **args):
+        """Record that something named name took duration seconds."""
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': round((start - self.start) * 1e6),
+            'dur': round(duration * 1e6),
+            'pid': self.pid,
+            'tid': pid or self.pid,
+            'args': args,
+        })
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """Record the time spent in the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.perf_counter() - start, **args)
+
+    def wrap_filters(self, template_env):
+        """Record the time spent in the filters of a Jinja2 environment."""
+        def wrap(name, function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name, 'filter'):
+                    return function(*args, **kwargs)
+            return wrapper
+        for name, function in template_env.filters.items():
+            if getattr(function, '__module__', None) == __name__:
+                template_env.filters[name] = wrap(name, function)
+
+    def totals(self, key):
+        """Return the count and total duration of events grouped by key(event)."""
+        totals = defaultdict(lambda: [0, 0])
+        for event in self.events:
+            group = key(event)
+            if group:
+                totals[group][0] += 1
+                totals[group][1] += event['dur']
+        return totals
+
+    def save(self, path, phases):
+        """Write the events and the total time of each phase to path."""
+        report = {
+            'traceEvents': self.events,
+            'displayTimeUnit': 'ms',
+            'phases': {name: round(seconds, 6) for name, seconds in sorted(phases.items())},
+        }
+        fwrite(path, json.dumps(report))
+
+    def summary(self, phases, top=10):
+        """Log the time spent in each phase and the slowest files and templates."""
+        log('Time per phase:')
+        for name, seconds in sorted(phases.items(), key=lambda item: -item[1]):
+            log('  {:>9.3f}s  {}', seconds, name)
+        # Writes are timed again by the render and list spans around them.
+        files = self.totals(lambda event: event['cat'] not in ('filter', 'write') and event['name'])
+        templates = self.totals(lambda event: event['args'].get('template') or
+                                (event['cat'] == 'filter' and 'filter: ' + event['name']))
+        for title, totals in (('files', files), ('templates and filters', templates)):
+            log('Slowest {}:', title)
+            for name, (count, duration) in sorted(totals.items(), key=lambda item: -item[1][1])[:top]:
+                log('  {:>9.3f}s  {} ({}x)', duration / 1e6, name, count)
+
+# Returned by Build.profile() when profiling is disabled.
+NOT_PROFILING = contextlib.nullcontext()
+
+# Rendered text is encoded in chunks of about this many characters, and
+# pages up to this many bytes are kept in memory instead of being streamed
+# to a temporary file.
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+def encode_chunks(chunks, size=STREAM_CHUNK_SIZE):
+    """Join small chunks of text and encode them as UTF-8 in larger chunks."""
+    buffer = []
+    buffered = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield ''.join(buffer).encode('utf-8')
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer).encode('utf-8')
+
+class Build:
+    """State shared by the functions that generate a site in one run."""
+
+    def __init__(self, parse_cache=None, workers=1, manifest=None, summaries=None,
+                 low_memory=False, renders=None):
+        self.parse_cache = parse_cache
+        self.summaries = summaries or SummaryCache()
+        self.renders = renders
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+        self.manifest = manifest
+        self.low_memory = low_memory
+        # Set in the runs of a sharded build, see Shard.
+        self.shard = None
+        # Used to generate only part of the site again, see restart().
+        self.changed = None
+        self.outputs = None
+        self.folder_outputs = {}
+        self.folder_lists = {}
+        self.page_series = {}
+        self.touched_series = set()
+        self.page_outputs = {}
+        # Content files read in full by scan_contents() in this build.
+        self.scanned_bodies = set()
+        # The (name, digest) of the templates each template is made of.
+        self.template_names = {}
+        # Metadata of every page of the site, see make_site().
+        self.graph = ContentGraph()
+        # Broken internal links by source, see check_links().
+        self.broken_links = {}
+        # Time spent in each phase of the build, see phase().
+        self.timings = defaultdict(float)
+        self.current_phase = None
+        self.phase_start = None
+        self.profiler = None
+
+    def profile(self, name, category, **args):
+        """Record the time spent in the with block if profiling is enabled."""
+        if not self.profiler:
+            return NOT_PROFILING
+        return self.profiler.span(name, category, **args)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Count the time spent in the with block towards a phase of the build.
+
+        Time spent in a phase nested in the block only counts towards the
+        nested phase.
+        """
+        outer = self.current_phase
+        self.switch_phase(name)
+        try:
+            yield
+        finally:
+            self.switch_phase(outer)
+
+    def switch_phase(self, name):
+        """Stop timing the current phase and start timing another one."""
+        now = time.perf_counter()
+        if self.current_phase:
+            self.timings[self.current_phase] += now - self.phase_start
+        self.current_phase, self.phase_start = name, now
+
+    def restart(self, folders=None, changed=None):
+        """Prepare to generate the site again in the same process.
+
+        folders and changed are the content folders and files that changed,
+        None meaning all of them. The outputs of other folders, and of the
+        pages that do not have to be rendered again, are carried over in
+        the manifest.
+        """
+        self.changed = changed
+        self.touched_series = set()
+        self.scanned_bodies = set()
+        # The templates may have changed since the last build.
+        self.template_names = {}
+        self.summaries.templates = {}
+        if self.renders:
+            self.renders.templates = {}
+        dropped = None
+        if folders is None:
+            self.folder_outputs = {}
+            self.folder_lists = {}
+        else:
+            dropped = set()
+            for dirpath in folders:
+                dropped.update(self.folder_outputs.pop(dirpath, ()))
+                self.folder_lists.pop(dirpath, None)
+        if self.manifest:
+            self.manifest.restart(dropped)
+
+    def update_series(self, items):
+        """Record the series of scanned items, noting those of changed items.
+
+        The series a changed item was in, before or after the change, are
+        touched: the navigation of every page in them may have to change.
+        """
+        for content in items:
+            src_path = content['src_path']
+            series = {s.get('title') for s in content.get('series') or ()}
+            if self.changed is not None and src_path in self.changed:
+                self.touched_series |= series | self.page_series.get(src_path, set())
+            self.page_series[src_path] = series
+
+    def forget_pages(self, src_paths):
+        """Forget the series of pages that were removed, touching them."""
+        for src_path in src_paths:
+            series = self.page_series.pop(src_path, set())
+            if self.changed is not None:
+                self.touched_series |= series
+
+    def pages_to_render(self, items):
+        """Return the src_path of the items whose pages have to be rendered.
+
+        That is every item, unless only some files changed since the last
+        build; then it is the changed items, the items in the series
+        touched by update_series(), and items any of whose outputs, e.g.
+        chapter pages, is missing.
+        """
+        if self.changed is None:
+            return {content['src_path'] for content in items}
+        return {content['src_path'] for content in items
+                if content['src_path'] in self.changed
+                or self.page_series.get(content['src_path'], set()) & self.touched_series
+                or not all(os.path.isfile(dst_path) for dst_path in
+                           self.page_outputs.get(content['src_path'], [content['dst_path']]))}
+
+    def template_dependents(self, names):
+        """Return the content folders and files to build after templates changed.
+
+        names are the names of the templates that changed. The result is
+        in the form changed_folders() returns.
+        """
+        outputs = self.manifest.dependents(templates=names)
+        folders = {dirpath for dirpath, filenames in self.folder_outputs.items()
+                   if any(self.manifest.key(filename) in outputs for filename in filenames)}
+        return folders, {entry['page'] for entry in outputs.values() if entry.get('page')}
+
+    def depend(self, filename, templates, sources, page=None):
+        """Record the templates and content files an output was generated from."""
+        if not self.manifest:
+            return
+        used = []
+        for template in templates:
+            if template.name not in self.template_names:
+                chain = template_chain(template)
+                self.template_names[template.name] = chain and [
+                    (name, hashlib.md5(source.encode()).hexdigest()) for name, source, ast in chain]
+            if self.template_names[template.name] is None:
+                used = None
+                break
+            used.extend(self.template_names[template.name])
+        self.manifest.depend(filename, used, sources, page)
+
+    def keep(self, filename):
+        """Keep an output of the previous build that was not written again."""
+        if self.outputs is not None:
+            self.outputs.add(filename)
+        if self.manifest:
+            self.manifest.keep(filename)
+
+    def write_stream(self, filename, chunks):
+        """Write an output file from text chunks as they are generated.
+
+        Once the output is larger than STREAM_BUFFER_SIZE, the rest of it
+        is streamed to a temporary file next to filename, which is renamed
+        into place at the end unless the manifest says the file is
+        unchanged. Returns the md5 digest of the output.
+        """
+        with self.profile(filename, 'write'):
+            if self.outputs is not None:
+                self.outputs.add(filename)
+            digest = hashlib.md5()
+            size = 0
+            buffer = []
+            tmp_file = None
+            tmp_path = filename + '.tmp'
+            try:
+                for data in encode_chunks(chunks):
+                    digest.update(data)
+                    size += len(data)
+                    if tmp_file:
+                        tmp_file.write(data)
+                        continue
+                    buffer.append(data)
+                    if size > STREAM_BUFFER_SIZE:
+                        make_parent_dirs(filename)
+                        tmp_file = open(tmp_path, 'wb')
+                        tmp_file.writelines(buffer)
+                        buffer = None
+            except BaseException:
+                if tmp_file:
+                    tmp_file.close()
+                    os.remove(tmp_path)
+                raise
+            digest = digest.hexdigest()
+
+            with self.phase('write'):
+                if not tmp_file:
+                    data = b''.join(buffer)
+                    if self.manifest:
+                        self.manifest.write(filename, data, digest)
+                    else:
+                        make_parent_dirs(filename)
+                        with open(filename, 'wb') as f:
+                            f.write(data)
+                    return digest
+                tmp_file.close()
+                if self.manifest:
+                    self.manifest.replace(filename, tmp_path, digest, size)
+                else:
+                    os.replace(tmp_path, filename)
+            return digest
+
+    def write_page(self, layout, page, sources=()):
+        """Render a page with layout and write it, returning the output's md5.
+
+        If the render cache has the page and its output is unchanged since
+        the previous build, the page is neither rendered nor written.
+        sources are the other content files the page shows.
+        """
+        key = None
+        md5 = None
+        if self.renders is not None and self.manifest:
+            key = self.renders.key(layout, page, page['dst_path'])
+            entry = key and self.renders.lookup(key)
+            if entry and self.manifest.unchanged(page['dst_path'], *entry):
+                self.keep(page['dst_path'])
+                md5 = entry[0]
+        if md5 is None:
+            log('Rendering {} => {} ...', page['src_path'], page['dst_path'])
+            with self.phase('render'), self.profile(page['dst_path'], 'render', template=layout.name):
+                md5 = self.write_stream(page['dst_path'], layout.generate(**page))
+            if key:
+                self.renders.store(key, md5, os.path.getsize(page['dst_path']))
+        self.depend(page['dst_path'], [layout], [page['src_path'], *sources], page['src_path'])
+        return md5
+
+    def release(self, content):
+        """Drop the full text of a page that has been written, in low memory mode.
+
+        Lists only need the page's metadata and summary, so the summary
+        lists would otherwise make from the text is made first.
+        """
+        if not self.low_memory:
+            return
+        if not content.get('summary'):
+            content['summary'] = truncate(content.get('content') or '')
+        content['content'] = ''
+        if 'chapters_content' in content:
+            content['chapters_content'] = []
+
+    def read_content(self, filename, **params):
+        """Read content through the parse cache if one is enabled."""
+        return self.read_contents([filename], **params)[0]
+
+    def read_contents(self, filenames, **params):
+        """Read several content files, in parallel if workers are enabled.
+
+        The returned list and the log output are in the same order as
+        filenames, whichever way the files were read.
+        """
+        return self.read_files(filenames, params, True)
+
+    def scan_contents(self, filenames, **params):
+        """Read the metadata of several content files, see read_metadata().
+
+        Unless in low memory mode, the files are read in full and their
+        text is kept for read_bodies(). In low memory mode, only the
+        metadata is read, except for files that are not in the parse cache,
+        which are read in full and stored so that their text can be read
+        from the cache later.
+        """
+        return self.read_files(filenames, params, False)
+
+    def read_bodies(self, contents, needed, **params):
+        """Yield contents, reading the text of those for which needed() is true.
+
+        The contents must have been read by scan_contents(); those that
+        already have their text are not read again. In low memory mode
+        their text is read a few at a time, so that only the text of the
+        contents being yielded is held at once if they are released after
+        use.
+        """
+        batch_size = self.workers * 4 if self.low_memory else max(len(contents), 1)
+        for i in range(0, len(contents), batch_size):
+            batch = contents[i:i + batch_size]
+            # A page's Context also holds its folder's params, which have
+            # the text of the folder's _index file.
+            wanted = [content for content in batch
+                      if needed(content) and 'content' not in getattr(content, 'maps', [content])[0]]
+            bodies = self.read_contents([content['src_path'] for content in wanted], **params)
+            for content, body in zip(wanted, bodies):
+                content.update((key, body[key]) for key in BODY_KEYS if key in body)
+            yield from batch
+
+    def read_files(self, filenames, params, body):
+        """Read content files, or only their metadata if body is False."""
+        with self.phase('parse'):
+            contents = [None] * len(filenames)
+            keys = [None] * len(filenames)
+            if self.parse_cache:
+                for i, filename in enumerate(filenames):
+                    lookup = self.parse_cache.lookup if body else self.parse_cache.lookup_metadata
+                    contents[i], keys[i] = lookup(filename, **params)
+            misses = [filename for content, filename in zip(contents, filenames) if content is None]
+            # Files are read in full to be rendered or cached, unless another
+            # shard renders them.
+            read_bodies = [body or (bool(self.parse_cache) or not self.low_memory)
+                           and (not self.shard or self.shard.owns(filename))
+                           for filename in misses]
+
+            if self.workers > 1 and len(misses) > 1:
+                if not self.pool:
+                    from concurrent.futures import ProcessPoolExecutor
+                    self.pool = ProcessPoolExecutor(self.workers)
+                chunksize = max(1, len(misses) // (self.workers * 4))
+                results = self.pool.map(read_content_captured, misses, [params] * len(misses),
+                                        read_bodies, chunksize=chunksize)
+            else:
+                results = map(read_content_captured, misses, [params] * len(misses), read_bodies)
+            read_bodies = iter(read_bodies)
+
+            for i, filename in enumerate(filenames):
+                if contents[i] is not None:
+                    # Files read in full by a scan were logged then.
+                    if body and filename not in self.scanned_bodies:
+                        log('Reading (cached): ' + filename)
+                    continue
+                read_body = next(read_bodies)
+                if read_body:
+                    log('Reading: ' + filename)
+                    if not body:
+                        self.scanned_bodies.add(filename)
+                contents[i], messages, timing = next(results)
+                sys.stderr.write(messages)
+                if self.profiler:
+                    pid, start, duration = timing
+                    self.profiler.add(filename, 'parse' if read_body else 'scan', start, duration, pid)
+                if self.parse_cache and read_body:
+                    self.parse_cache.store(filename, keys[i], contents[i])
+                if not body and self.low_memory:
+                    contents[i] = {key: value for key, value in contents[i].items() if key not in BODY_KEYS}
+            return contents
+
+    def close(self):
+        """Shut down worker processes and save the caches."""
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+        if self.parse_cache:
+            self.parse_cache.save()
+        self.summaries.save()
+        if self.renders:
+            self.renders.save()
+        if self.manifest:
+            self.manifest.save()
 
 def render(template, **params):
     # Replace placeholders in template with values from params.
@@ -332,71 +1681,228 @@ def render_metadata(params, template):
 def format_metadata(val, format):
     return format.format(**val)
 
+def attribute_values(item, attribute):
+    """Return the values of attribute that item is grouped by.
+
+    Each value comes with the changes to the item that make it a work with
+    just that value, e.g. a single fandom, or the title and index of a
+    single series.
+    """
+    if properties := item.get(attribute):
+        if 'series' == attribute:
+            return [(property.get('title'), {'series': property.get('title'), 'series_index': property.get('index')})
+                    for property in properties]
+        elif not isinstance(properties, str) and isinstance(properties, Iterable):
+            return [(property, {attribute: property}) for property in properties]
+        else:
+            return [(properties, {})]
+    return [('', {attribute: ''})]
+
 def flatten_by_attribute(value, attribute):
+    """Return one item per value of attribute for each item in value."""
     output = []
     for item in value:
-        if properties := item.get(attribute):
-            if 'series' == attribute:
-                for property in properties:
-                    output.append({ **item, **{'series': property.get('title'), 'series_index': property.get('index') } })
-            elif not isinstance(properties, str) and isinstance(properties, Iterable):
-                for property in properties:
-                    output.append({ **item, **{attribute: property} })
-            else:
-                output.append(item)
-
-        else:
-            output.append({ **item, **{attribute: ''} })
+        for group, changes in attribute_values(item, attribute):
+            output.append(Context(changes, item) if changes else item)
     return output
 
-def group_fandoms(config, works):
-    fandom_groups = config.get('fandom_groups', [])
-    if not fandom_groups: return works
+def group_fandoms(rules, works):
+    """Repeat each work for each of its fandoms, or the groups they are in.
+
+    The repeated works are Context views of the work rather than copies.
+    """
+    if not rules.fandom_groups: return works
     grouped_works = []
     for work in works:
         if fandoms := work.get('fandom'):
             for fandom in fandoms:
-                grouped = False
-                for fandom_grouping in fandom_groups:
-                    fandom_group = fandom_grouping[0]
-                    if fandom in fandom_grouping:
-                        grouped_works.append({ **work, **{'fandom': fandom_group, 'subfandom': fandom} })
-                        grouped = True
-                if not grouped:
-                    grouped_works.append({ **work, **{'fandom': fandom} })
+                if fandom_groups := rules.fandom_groups.get(fandom):
+                    for fandom_group in fandom_groups:
+                        grouped_works.append(Context({'fandom': fandom_group, 'subfandom': fandom}, work))
+                else:
+                    grouped_works.append(Context({'fandom': fandom}, work))
 
         else:
-            grouped_works.append({ **work, **{'fandom': config.get('no_fandom_label','')} })
+            grouped_works.append(Context({'fandom': rules.config.get('no_fandom_label','')}, work))
     return grouped_works
 
-def group_recursive(items, groups, depth = 0):
+def group_entries(items, groups):
+    """Return the entries that group_recursive() makes its output from.
+
+    Each item is expanded into one (keys, changes, item) entry for every
+    combination of values it is grouped under, where keys are the values
+    and changes the attributes set to them. The entries refer to the item
+    rather than copying it, and are sorted by keys.
+    """
+    entries = [((), {}, item) for item in items]
+    for attribute in groups:
+        expanded = []
+        for keys, changes, item in entries:
+            for group, group_changes in attribute_values(ChainMap(changes, item) if changes else item, attribute):
+                expanded.append((keys + (group,), {**changes, **group_changes}, item))
+        entries = expanded
+    entries.sort(key=lambda entry: entry[0]) # Stable, so items within a group keep their order
+    return entries
+
+def grouped_output(entries, depth=0):
+    """Return the (group, items, depth) tuples for sorted group entries.
+
+    The output starts with the headings of every group the first entry is
+    in, so a slice of the entries gets the headings it continues.
+    """
     output = []
-    attribute = groups[depth]
-    items = flatten_by_attribute(items, attribute) # If the attribute is a list this will fix it
-    items.sort(key=lambda x: x.get(attribute)) # groupby() requires input to be sorted
-    for group, values in groupby(items, key=lambda x: x.get(attribute)):
-        values = list(values)
-        if depth+1 < len(groups):
-            group_items = []
-            empty_group = False
-            next_group = group_recursive(values, groups, depth+1) # To understand recursion you must first understand recursion
-            if (group): # Only adding it to the output if the group has a value
-                # FB: Disabled until I figure out a better solution for this issue
-                # for i, item in enumerate(next_group): #Checking the next iteration to see if contains an empty group
-                #     if not item[0]:
-                #         empty_group = i
-                #         group_items = item[1] #Add the empty group's items to this group
-                #         break
-                # if empty_group: #Remove the empty group
-                #     next_group.pop(empty_group)
-                output.append((group, group_items, depth))
-            output.extend(next_group)
-        else:
-            # This will output an empty group - it would be better if we could append it
-            #  to the previous non-empty group instead so the depth is useful in the template
-            output.append((group, values, depth))
+    previous = None
+    for keys, changes, item in entries:
+        last = len(keys) - 1
+        item = Context(changes, item) if changes else item
+        level = 0
+        if previous is not None:
+            while level <= last and keys[level] == previous[level]:
+                level += 1
+        if level > last:
+            output[-1][1].append(item)
+            continue
+        for level in range(level, last):
+            if keys[level]: # Only adding it to the output if the group has a value
+                output.append((keys[level], [], depth + level))
+        # This will output an empty group - it would be better if we could append it
+        #  to the previous non-empty group instead so the depth is useful in the template
+        output.append((keys[last], [item], depth + last))
+        previous = keys
     return output
 
+def group_recursive(items, groups, depth = 0):
+    """Group items by each attribute in groups[depth:] in turn.
+
+    Returns a list of (group, items, depth) tuples in heading order: a
+    tuple with no items for each non-empty group at every level but the
+    last, and the items of each group at the last level. An item with
+    several values for an attribute, e.g. a work in two fandoms, appears
+    in the group of each value, with the attribute set to that value.
+    Groups are sorted by value, and items within a group keep their order.
+    """
+    return grouped_output(group_entries(items, groups[depth:]), depth)
+
+def paginate(items, groups, page_size):
+    """Split list items into pages of at most page_size items.
+
+    An item counts as its item_count, if it has one, e.g. a part of a
+    folder's list in a flattened site. Returns a list of (items,
+    grouped_items) pairs, one per page. If groups is given, items are
+    paginated in group order, and grouped_items holds the output of
+    group_recursive() for the page, starting with the headings of the
+    groups it continues from the previous page.
+    """
+    if groups:
+        entries = group_entries(items, groups)
+    else:
+        entries = [((), {}, item) for item in items]
+    chunks = [[]]
+    size = 0
+    for entry in entries:
+        count = entry[2].get('item_count', 1)
+        if chunks[-1] and size + count > page_size:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(entry)
+        size += count
+    pages = []
+    for chunk in chunks:
+        page_items = list({id(item): item for keys, changes, item in chunk}.values())
+        pages.append((page_items, grouped_output(chunk) if groups else None))
+    return pages
+
+class Context(ChainMap):
+    """Layered mapping of site defaults, folder overrides and page metadata.
+
+    Lookups search the layers from the most specific to the least specific
+    without copying any of them, and assignments only change the first
+    layer. Nested values such as display_options are shared with the
+    layers below, so use mutable() to get a private copy before changing
+    one in place.
+    """
+
+    def mutable(self, key):
+        """Return the value of key, copied into the first layer if needed."""
+        if key not in self.maps[0]:
+            self.maps[0][key] = copy.deepcopy(self[key])
+        return self.maps[0][key]
+
+def field_values(value):
+    """Return the values of a metadata field that holds a value or a list of them."""
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return [item for item in value if isinstance(item, str)]
+    return []
+
+class ContentGraph:
+    """Metadata of the pages of every content folder, indexed for lookups.
+
+    make_site() scans every content folder into the site's graph before
+    any page is rendered, so that a page can find pages in other folders
+    by slug, uri, series or tag without going through all of them.
+    """
+
+    INDEXED_FIELDS = ('fandom', 'relationship', 'character', 'additional_tags')
+
+    def __init__(self, items=()):
+        self.folders = {None: list(items)} if items else {}
+        self.index()
+
+    def set_folder(self, dirpath, items):
+        """Replace the pages of a content folder. Call index() afterwards."""
+        self.folders[dirpath] = items
+
+    def keep_folders(self, dirpaths):
+        """Forget the pages of content folders that are not in dirpaths."""
+        for dirpath in self.folders.keys() - set(dirpaths):
+            del self.folders[dirpath]
+
+    def index(self):
+        """Index the pages of every folder."""
+        self.by_src_path = {}
+        self.by_slug = defaultdict(list)
+        self.by_uri = {}
+        self.series = defaultdict(dict)
+        self.series_sources = defaultdict(dict)
+        self.by_field = {field: defaultdict(list) for field in self.INDEXED_FIELDS}
+        for items in self.folders.values():
+            for content in items:
+                self.by_src_path[content['src_path']] = content
+                self.by_slug[content.get('slug')].append(content)
+                self.by_uri[content['uri']] = content
+                for s in content.get('series') or ():
+                    self.series[s.get('title')][s.get('index')] = { 'uri': generate_uri(content), 'title': content['title'] }
+                    self.series_sources[s.get('title')][s.get('index')] = content['src_path']
+                for field in self.INDEXED_FIELDS:
+                    for value in field_values(content.get(field)):
+                        self.by_field[field][value].append(content)
+
+    def pages_with(self, field, value):
+        """Return the pages whose field, e.g. fandom, has value."""
+        return self.by_field[field].get(value, [])
+
+    def series_nav(self, content):
+        """Link each series of a page to the previous and next work in it.
+
+        Returns the src_path of the works linked to.
+        """
+        linked = []
+        for s in content.get('series') or ():
+            series_works = self.series.get(s.get('title'), {})
+            series_sources = self.series_sources.get(s.get('title'), {})
+            current_index = int(s.get('index'))
+            s.pop('next', None)
+            s.pop('prev', None)
+            if next_work := series_works.get(str(current_index +1)):
+                s['next'] = next_work
+                linked.append(series_sources[str(current_index +1)])
+            if prev_work := series_works.get(str(current_index -1)):
+                s['prev'] = prev_work
+                linked.append(series_sources[str(current_index -1)])
+        return linked
+
 def generate_uri(content):
     site_dir = os.path.normpath(content.get('output_dir', '_site'))
     if content.get('dst_path'):
@@ -414,14 +1920,20 @@ def generate_html_id(text):
     text = text.casefold()
     return re.sub("\W", "", text)
 
-def make_pages(src, dst, layout, **params):
+def make_pages(src, dst, layout, build=None, **params):
     """Generate pages from page content."""
+    if build is None:
+        build = Build()
+    items = scan_pages(src, dst, build, **params)
+    build.update_series(items)
+    return render_pages(items, layout, build, ContentGraph(items), **params)
+
+def scan_pages(src, dst, build, **params):
+    """Read the metadata of the pages of a content folder, see read_metadata()."""
     items = []
-    series_nav = defaultdict(dict)
-
-    for src_path in glob.glob(src):
-        content = read_content(src_path, **params)
-        content = dict(params, **content)
+    src_paths = glob.glob(src)
+    for src_path, content in zip(src_paths, build.scan_contents(src_paths, **params)):
+        content = Context(content, params)
 
         content['src_path'] = src_path
 
@@ -435,23 +1947,26 @@ def make_pages(src, dst, layout, **params):
         if not content.get('uri'):
             content['uri'] = generate_uri(content)
 
-        #Put all series information in a list so we can generate next/previous work links
-        if series := content.get('series'):
-            for s in series:
-                series_nav[s.get('title')][s.get('index')] = { 'uri': generate_uri(content), 'title': content['title'] }
-
         items.append(content)
+    return items
+
+def render_pages(items, layout, build, graph, **params):
+    """Read the text of scanned pages and generate the pages.
+
+    Series navigation links to the pages in graph. Returns the items.
+    """
+    render_paths = build.pages_to_render(items)
+    if build.low_memory:
+        # Pages that are not rendered only need their text for the summary
+        # lists make from it.
+        needed = lambda content: (content['src_path'] in render_paths and not content.get('skip_rendering')
+                                  or not content.get('summary'))
+    else:
+        needed = lambda content: True
 
     #Create the content files, and generate series navigation
-    for content in items:
-        if series := content.get('series'):
-            for i, s in enumerate(series):
-                series_works = series_nav.get(s.get('title'))
-                current_index = int(s.get('index'))
-                if next_work := series_works.get(str(current_index +1)):
-                    s['next'] = next_work
-                if prev_work := series_works.get(str(current_index -1)):
-                    s['prev'] = prev_work
+    for content in build.read_bodies(items, needed, **params):
+        linked = graph.series_nav(content)
 
         # page_params = dict(params, **content)
 
@@ -467,21 +1982,79 @@ def make_pages(src, dst, layout, **params):
 
         # rel_path = os.path.relpath(content['src_path'], 'content')
 
-        output = layout.render(**content)
-        
-        import hashlib
-        contents_hash = hashlib.md5(output.encode())
-        content['md5'] = contents_hash.hexdigest()
-
-        if not content.get('skip_rendering'):
-            log('Rendering {} => {} ...', content['src_path'], content['dst_path'])
-            fwrite(content['dst_path'], output)
+        if content['src_path'] not in render_paths:
+            for dst_path in build.page_outputs.get(content['src_path'], [content['dst_path']]):
+                build.keep(dst_path)
+        elif not content.get('skip_rendering'):
+            pages = chapter_pages(content) or [content]
+            build.page_outputs[content['src_path']] = [page['dst_path'] for page in pages]
+            for page in pages:
+                md5 = build.write_page(layout, page, linked)
+                if page['dst_path'] == content['dst_path']:
+                    content['md5'] = md5
+        build.release(content)
 
     return items
     # return sorted(items, key=lambda x: x['date'], reverse=True)
 
-def make_list(files, dst, list_layout, item_layout, **params):
-    """Generate list page for a blog."""
+def chapter_pages(content):
+    """Return the pages of a work that is split into one page per chapter.
+
+    A work is split if it has at least display_options.chapter_pages
+    chapters or chapter_pages_words words; otherwise an empty list is
+    returned. The work's own page gets a table of contents instead of
+    the chapters, which get chapter-N pages next to it, and with
+    full_work_page the whole work is also written to a full page.
+    """
+    config = content.get('display_options') or {}
+    chapters = content.get('chapters_content') or []
+    min_chapters = config.get('chapter_pages')
+    min_words = config.get('chapter_pages_words')
+    if len(chapters) < 2 or not (min_chapters and len(chapters) >= min_chapters
+                                 or min_words and (content.get('words') or 0) >= min_words):
+        return []
+
+    dst_path = content['dst_path']
+    if os.path.basename(dst_path) == 'index.html':
+        base_dir = os.path.dirname(dst_path)
+        page_path = lambda name: os.path.join(base_dir, name, 'index.html')
+    else:
+        base_dir = os.path.splitext(dst_path)[0]
+        page_path = lambda name: os.path.join(base_dir, name + '.html')
+    page_uri = lambda path: generate_uri(Context({'dst_path': path}, content))
+    chapter_paths = [page_path('chapter-{}'.format(number)) for number in range(1, len(chapters) + 1)]
+    chapter_uris = [page_uri(path) for path in chapter_paths]
+    full_path = page_path('full') if config.get('full_work_page') else None
+    shared = {
+        'chapter_pages': [{'title': chapter.get('title'), 'uri': uri}
+                          for chapter, uri in zip(chapters, chapter_uris)],
+        'work_uri': content['uri'],
+        'full_work_uri': full_path and page_uri(full_path),
+    }
+
+    pages = [Context(dict(shared, chapters_content=[], content=''), content)]
+    for i, chapter in enumerate(chapters):
+        pages.append(Context(dict(shared,
+            chapters_content=[chapter],
+            content=chapter.get('content', ''),
+            chapter_number=i + 1,
+            prev_chapter_uri=chapter_uris[i - 1] if i > 0 else None,
+            next_chapter_uri=chapter_uris[i + 1] if i + 1 < len(chapters) else None,
+            dst_path=chapter_paths[i],
+            uri=chapter_uris[i],
+        ), content))
+    if full_path:
+        pages.append(Context(dict(shared, full_work=True, dst_path=full_path,
+                                  uri=shared['full_work_uri']), content))
+    return pages
+
+def make_list(files, dst, list_layout, item_layout, build=None, **params):
+    """Generate list page for a blog.
+
+    If dst is None, the list is returned instead of being written.
+    """
+    if build is None:
+        build = Build()
     config = params.get("display_options")
     items = []
 
@@ -499,18 +2072,22 @@ def make_list(files, dst, list_layout, item_layout, **params):
         files.sort(key=sort_series, reverse=True)
     
     for item in files:
-        item_params = dict(params, **item)
+        item_params = Context({}, item, params)
         if not item_params.get('summary'):
             item_params['summary'] = truncate(item['content'])
         if item_layout:
-            item_content = item_layout.render(**item_params)
+            with build.profile(item.get('src_path') or item.get('title'), 'summary', template=item_layout.name):
+                item_content = build.summaries.render(item_layout, item_params)
             # item_params = render_metadata(item_params, template="summary")
             item_params['content'] = item_content
         if not item_params.get('exclude_from_index', False): 
             items.append(item_params)
     
     if (config.get('group_by')):
-        items = group_fandoms(params.get("tag_processing"), items)
+        items = group_fandoms(tag_rules(params), items)
+
+    if config.get('page_size'):
+        return make_list_pages(items, dst, list_layout, build, item_layout, **params)
 
     params['items'] = items
     if (dst):
@@ -518,13 +2095,63 @@ def make_list(files, dst, list_layout, item_layout, **params):
         params["dst_path"] = dst_path
         params["uri"] = generate_uri(params)
         log('Rendering list => {} ...', dst_path)
-        output = list_layout.render(**params)
-        fwrite(dst_path, output)
+        with build.profile(dst_path, 'list', template=list_layout.name):
+            build.write_stream(dst_path, list_layout.generate(**params))
+        build.depend(dst_path, [list_layout, item_layout] if item_layout else [list_layout], list_sources(files))
+        output = None
     else:
-        output = list_layout.render(**params)
+        with build.profile(params.get('title') or 'list', 'list', template=list_layout.name):
+            output = list_layout.render(**params)
     
     return output
 
+def make_list_pages(items, dst, list_layout, build, item_layout=None, **params):
+    """Generate the pages of a list paginated by display_options.page_size.
+
+    The first page is written to dst and page N to page/N/index.html next
+    to it. Returns the output, or None if it was written, and the number
+    of items of each page. item_layout is only used to record what the
+    pages were generated from.
+    """
+    config = params.get("display_options")
+    pages = paginate(items, config.get('group_by'), config['page_size'])
+    dst_paths = [None] * len(pages)
+    if dst:
+        dst_paths[0] = render(dst, **params)
+        for number in range(2, len(pages) + 1):
+            dst_paths[number - 1] = os.path.join(os.path.dirname(dst_paths[0]), 'page', str(number), 'index.html')
+    uris = [dst_path and generate_uri(Context({'dst_path': dst_path}, params)) for dst_path in dst_paths]
+
+    outputs = []
+    for i, (page_items, grouped_items) in enumerate(pages):
+        page_params = Context({
+            'items': page_items,
+            'grouped_items': grouped_items,
+            'page_number': i + 1,
+            'page_count': len(pages),
+            'page_uris': uris,
+            'prev_page_uri': uris[i - 1] if i > 0 else None,
+            'next_page_uri': uris[i + 1] if i + 1 < len(pages) else None,
+            'dst_path': dst_paths[i],
+            'uri': uris[i],
+        }, params)
+        if dst_paths[i]:
+            log('Rendering list => {} ...', dst_paths[i])
+            with build.profile(dst_paths[i], 'list', template=list_layout.name):
+                build.write_stream(dst_paths[i], list_layout.generate(**page_params))
+            build.depend(dst_paths[i], [list_layout, item_layout] if item_layout else [list_layout],
+                         list_sources(page_items))
+            output = None
+        else:
+            with build.profile(params.get('title') or 'list', 'list', template=list_layout.name):
+                output = list_layout.render(**page_params)
+        outputs.append((output, sum(item.get('item_count', 1) for item in page_items)))
+    return outputs
+
+def list_sources(items):
+    """Return the content files of the items of a list."""
+    return [item['src_path'] for item in items if item.get('src_path')]
+
 def sort_series(item):
     if item.get('series'):
         series_sort = []
@@ -534,32 +2161,89 @@ def sort_series(item):
     else:
         return ( '', 0 )
 
-def get_templates(template_env, theme_dir, folder):
-    single_layout = template_env.get_template('single.html.j2')
-    list_layout = template_env.get_template('list.html.j2')
-    summary_layout = template_env.get_template('summary.html.j2')
-    needed_templates = { 'single': True, 'summary': True, 'list': True}
-    folder_tree = folder.split(os.sep)
-    theme_templates_dir = os.path.join(theme_dir, 'templates')
-    while folder_tree:
-        template_path = os.path.join(*folder_tree)
-        print('Template path: ' + template_path)
-        if os.path.isdir(os.path.join(theme_templates_dir, template_path)):
-            template_filenames = os.listdir(os.path.join(theme_templates_dir, template_path))
-            if needed_templates['single'] and 'single.html.j2' in template_filenames:
-                single_layout = template_env.get_template( pathlib.posixpath.join(template_path, 'single.html.j2'))
-                needed_templates['single'] = False
-            if needed_templates['summary'] and 'summary.html.j2' in template_filenames:
-                summary_layout = template_env.get_template( pathlib.posixpath.join(template_path, 'summary.html.j2'))
-                needed_templates['summary'] = False
-            if needed_templates['list'] and 'list.html.j2' in template_filenames:
-                list_layout = template_env.get_template( pathlib.posixpath.join(template_path, 'list.html.j2'))
-                needed_templates['list'] = False
-        folder_tree.pop()
-    return (single_layout, list_layout, summary_layout)
-
-def main():
-
+class TemplateIndex:
+    """The single, list and summary templates of a theme for each content folder.
+
+    A template in a subfolder of the theme's templates folder overrides the
+    one with the same name for the content folder at the same path and its
+    subfolders, the nearest one winning. The templates folder is scanned
+    once, and the templates of each content folder are looked up once.
+    """
+
+    LAYOUTS = ('single.html.j2', 'list.html.j2', 'summary.html.j2')
+
+    def __init__(self, template_env, theme_dir):
+        self.template_env = template_env
+        self.overrides = {}
+        self.resolved = {}
+        templates_dir = os.path.join(theme_dir, 'templates')
+        for dirpath, dirnames, filenames in os.walk(templates_dir):
+            folder = os.path.relpath(dirpath, templates_dir)
+            if folder != os.curdir:
+                self.overrides[tuple(folder.split(os.sep))] = set(self.LAYOUTS).intersection(filenames)
+
+    def get(self, folder):
+        """Return the (single, list, summary) templates for a content folder."""
+        if folder not in self.resolved:
+            folder_tree = tuple(folder.split(os.sep))
+            layouts = []
+            for name in self.LAYOUTS:
+                for depth in range(len(folder_tree), 0, -1):
+                    if name in self.overrides.get(folder_tree[:depth], ()):
+                        name = '/'.join(folder_tree[:depth] + (name,))
+                        break
+                layouts.append(self.template_env.get_template(name))
+            self.resolved[folder] = tuple(layouts)
+        return self.resolved[folder]
+
+def parse_args(argv):
+    """Parse command line arguments."""
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--no-cache', action='store_true',
+                        help='read every content file without using the parse cache')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='delete the parse cache before building')
+    parser.add_argument('--incremental', action='store_true',
+                        help='keep the output directory and only write files that changed')
+    parser.add_argument('--workers', type=int, metavar='N',
+                        help='number of processes used to read content files, 0 for one per CPU')
+    parser.add_argument('--compile-theme', action='store_true',
+                        help='compile the theme templates into the cache folder to be used by later builds')
+    parser.add_argument('--profile', nargs='?', const='', metavar='FILE',
+                        help='time each phase, file and template, save the timings to FILE '
+                             '(default: profile.json in the cache folder) and show the slowest ones')
+    parser.add_argument('--watch', action='store_true',
+                        help='generate the site again whenever its sources change')
+    parser.add_argument('--port', type=int, default=8000, metavar='N',
+                        help='port to serve the site on while watching, 0 to not serve it (default: 8000)')
+    parser.add_argument('--check-links', action='store_true',
+                        help='report internal links in the generated pages that lead nowhere')
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N',
+                        help='generate only the pages of shard I of N, see --merge')
+    parser.add_argument('--merge', type=int, metavar='N',
+                        help='generate the lists of a site generated by N shards')
+    args = parser.parse_args(argv)
+    if args.shard and args.merge:
+        parser.error('--shard and --merge can not be used together')
+    if args.watch and (args.shard or args.merge):
+        parser.error('--watch can not be used with --shard or --merge')
+    if args.merge is not None and args.merge < 1:
+        parser.error('--merge needs the number of shards')
+    return args
+
+def parse_shard(text):
+    """Parse the I/N value of --shard into (I, N)."""
+    index, count = (int(part) for part in text.split('/'))
+    if not 1 <= index <= count:
+        raise ValueError(text)
+    return index, count
+
+def load_params():
+    """Return the default params updated with the ones in params.json.
+
+    If params.json does not exist, it is created from the defaults.
+    """
     # Default parameters.
     params = {
         'base_path': '/',
@@ -597,12 +2281,24 @@ def main():
             'categories': 'category',
             'additional tag': 'additional_tags',
             'archive warnings': 'archive_warning'
+         },
+        'build_options': {
+            "cache": True,
+            "cache_dir": ".makesite-cache",
+            "workers": 1,
+            "incremental": False,
+            "ao3_parser": "bs4",
+            "template_cache": False,
+            "summary_cache": False,
+            "render_cache": False,
+            "render_cache_size": RENDER_CACHE_SIZE,
+            "low_memory": False,
+            "deploy_dir": "",
+            "skip_unchanged": False,
+            "check_links": False,
          }
     }
 
-    sys.stdin.reconfigure(encoding='utf-8')
-    sys.stdout.reconfigure(encoding='utf-8')
-
     # If params.json exists, load it, otherwise create it.
     if os.path.isfile('params.json'):
         # We can't do a traditional merge because this dictionary contains another dictionary
@@ -642,94 +2338,699 @@ def main():
         with open('params.json', 'w') as outfile:
             json.dump(params, outfile, indent=2)
 
-    theme_dir = f"themes/{params.get('theme', 'default') }"
-    site_dir = params.get('output_dir', '_site')
-
-    # Create a new _site directory from scratch.
-    if os.path.isdir(site_dir):
-        shutil.rmtree(site_dir, ignore_errors=False)
-    shutil.copytree(f'{ theme_dir }/static', site_dir)
-
-    #Load Jinja2 templates
-    template_env = jinja2.Environment(loader=jinja2.FileSystemLoader(f'{ theme_dir }/templates'))
+    params['tag_rules'] = TagRules(params['tag_processing'])
+    return params
+
+def template_sources(theme_dir):
+    """Return the digest of every template of a theme, by template name."""
+    import jinja2
+    templates_dir = os.path.join(theme_dir, 'templates')
+    sources = {'jinja2': jinja2.__version__}
+    for dirpath, dirnames, filenames in os.walk(templates_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, templates_dir).replace(os.sep, '/')
+            sources[name] = file_digest(path)
+    return sources
+
+def compiled_theme_dir(theme_dir, cache_dir):
+    """Return the folder that holds the compiled templates of a theme."""
+    return os.path.join(cache_dir, 'compiled-templates', os.path.basename(theme_dir))
+
+def compile_theme(theme_dir, cache_dir):
+    """Compile every template of a theme, including folder overrides, to Python modules."""
+    compiled_dir = compiled_theme_dir(theme_dir, cache_dir)
+    if os.path.isdir(compiled_dir):
+        shutil.rmtree(compiled_dir)
+    log('Compiling {} => {} ...', os.path.join(theme_dir, 'templates'), compiled_dir)
+    make_template_env(theme_dir).compile_templates(compiled_dir, zip=None, ignore_errors=False)
+    fwrite(os.path.join(compiled_dir, 'sources.json'),
+           json.dumps(template_sources(theme_dir), indent=1, sort_keys=True))
+
+def make_template_env(theme_dir, build_options=None):
+    """Create the Jinja2 environment for the templates of a theme.
+
+    If the theme was compiled with compile_theme() and its templates have
+    not changed since, the compiled templates are loaded instead of the
+    sources. If the template_cache build option is enabled, templates
+    compiled from source are cached in the cache folder.
+    """
+    import jinja2
+    build_options = build_options or {}
+    cache_dir = build_options.get('cache_dir')
+    loader = jinja2.FileSystemLoader(f'{ theme_dir }/templates')
+    bytecode_cache = None
+    if cache_dir:
+        compiled_dir = compiled_theme_dir(theme_dir, cache_dir)
+        sources_path = os.path.join(compiled_dir, 'sources.json')
+        if os.path.isfile(sources_path):
+            if json.loads(fread(sources_path)) == template_sources(theme_dir):
+                loader = jinja2.ChoiceLoader([jinja2.ModuleLoader(compiled_dir), loader])
+            else:
+                log('WARNING: Ignoring out of date compiled templates in {}', compiled_dir)
+        if build_options.get('template_cache'):
+            bytecode_dir = os.path.join(cache_dir, 'templates')
+            os.makedirs(bytecode_dir, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_dir)
+    template_env = jinja2.Environment(loader=loader, bytecode_cache=bytecode_cache)
     template_env.trim_blocks = True
     template_env.lstrip_blocks = True
     template_env.filters["flattenbyattribute"] = flatten_by_attribute
     template_env.filters["grouprecursive"] = group_recursive
     template_env.filters["htmlid"] = generate_html_id
     template_env.filters["humanformat"] = human_format
+    return template_env
+
+def scan_folder(dirpath, dirnames, params, build, site_dir):
+    """Read the metadata of a content folder and of its pages.
+
+    Returns the folder's params, the items of its subfolders to include
+    in its list and the items of its pages.
+    """
+    folder = os.path.relpath(dirpath, 'content')
+    log('Reading ' + dirpath)
+    folder_params = Context({}, params)
+    folder_items = list()
+
+    # Fetching metadata for the index page (also sets defaults for content in this folder)
+    if os.path.isfile( os.path.join(dirpath, '_index.html') ):
+        folder_params.update(build.read_content(os.path.join(dirpath, '_index.html'), **folder_params))
+    elif os.path.isfile( os.path.join(dirpath, '_index.md') ):
+        folder_params.update(build.read_content(os.path.join(dirpath, '_index.md'), **folder_params))
+
+    if params.get('include_folders_in_index'):
+        for dirname in dirnames:
+            folder_content = None
+            if os.path.isfile( os.path.join(dirpath, dirname, '_index.html') ):
+                folder_content = build.read_content( os.path.join(dirpath, dirname, '_index.html'), **params)
+            elif os.path.isfile( os.path.join(dirpath, dirname, '_index.md') ):
+                folder_content = build.read_content( os.path.join(dirpath, dirname, '_index.md'), **params)
+            if folder_content:
+                dst_path = os.path.join(site_dir, folder, dirname, 'index.html')
+                folder_content['uri'] = generate_uri( { 'base_path': params['base_path'], 'dst_path': dst_path })
+                folder_items.append(folder_content)
+
+    if params.get('pretty_uris'):
+        dst_path = os.path.normpath(os.path.join(site_dir, folder, '{{ slug }}/index.html'))
+    else:
+        dst_path = os.path.normpath(os.path.join(site_dir, folder, '{{ slug }}.html'))
 
-    single_layout = template_env.get_template('single.html.j2')
-    list_layout = template_env.get_template('list.html.j2')
-    summary_layout = template_env.get_template('summary.html.j2')
+    items = scan_pages(os.path.join(dirpath, '[!_]*.*'), dst_path, build, **folder_params)
+    return folder_params, folder_items, items
 
-    # Create subfolder pages.
-    theme_folder_templates = False
-    # if os.listdir(os.path.join(theme_dir, 'templates')):
-    if next(os.walk(os.path.join(theme_dir, 'templates')))[1]:
-        theme_folder_templates = True
+def make_site(params, build, template_env, folders=None):
+    """Generate the pages and lists of the content folders.
 
-    site_output = list() #Only used if site structure is flattened
+    The site is generated in two passes. The metadata of every content
+    folder is scanned into build.graph first, so that pages can link to
+    pages in other folders, e.g. the next work of a series; then the
+    pages and lists are rendered.
 
-    if not os.path.isdir('content'):
-        shutil.copytree(f'sample-content/default', 'content')
+    If folders is given, only those content folders, and the folders
+    with pages in a series that changed, are generated. The lists of the
+    other folders, which the site index needs when the site structure is
+    flattened, are reused from the previous call with the same build.
+    """
+    theme_dir = f"themes/{params.get('theme', 'default') }"
+    site_dir = params.get('output_dir', '_site')
+
+    templates = TemplateIndex(template_env, theme_dir)
 
+    site_output = list() #Only used if site structure is flattened
+
+    walk = []
     for (dirpath, dirnames, filenames) in os.walk('content', topdown=True):
-        log('Reading ' + dirpath)
         dirnames.sort()
-        folder_params = copy.deepcopy(params)
+        walk.append((dirpath, list(dirnames)))
+
+    # Scan the metadata of the site into the graph.
+    graph = build.graph
+    graph.keep_folders(dirpath for dirpath, dirnames in walk)
+    scanned = {}
+    def scan(dirpath, dirnames):
+        scanned[dirpath] = scan_folder(dirpath, dirnames, params, build, site_dir)
+        items = scanned[dirpath][2]
+        old_paths = {content['src_path'] for content in graph.folders.get(dirpath, ())}
+        build.forget_pages(old_paths - {content['src_path'] for content in items})
+        build.update_series(items)
+        graph.set_folder(dirpath, items)
+    for dirpath, dirnames in walk:
+        if folders is None or dirpath in folders:
+            scan(dirpath, dirnames)
+    if build.touched_series:
+        # Pages in other folders link to the pages of the series that changed.
+        for dirpath, dirnames in walk:
+            if dirpath not in scanned and any(build.page_series.get(content['src_path'], set()) & build.touched_series
+                                              for content in graph.folders.get(dirpath, ())):
+                scan(dirpath, dirnames)
+    graph.index()
+
+    for dirpath, dirnames in walk:
         folder = os.path.relpath(dirpath, 'content')
-        folder_items = list()
-
-        # Fetching metadata for the index page (also sets defaults for content in this folder)
-        if os.path.isfile( os.path.join(dirpath, '_index.html') ):
-            folder_params.update(read_content(os.path.join(dirpath, '_index.html'), **folder_params))
-        elif os.path.isfile( os.path.join(dirpath, '_index.md') ):
-            folder_params.update(read_content(os.path.join(dirpath, '_index.md'), **folder_params))
-            
-        if params.get('include_folders_in_index'):
-            for dirname in dirnames:
-                if os.path.isfile( os.path.join(dirpath, dirname, '_index.html') ):
-                    folder_content = read_content( os.path.join(dirpath, dirname, '_index.html'), **params)
-                elif os.path.isfile( os.path.join(dirpath, dirname, '_index.md') ):
-                    folder_content = read_content( os.path.join(dirpath, dirname, '_index.md'), **params)
-                if folder_content:
-                    dst_path = os.path.join(site_dir, folder, dirname, 'index.html')          
-                    folder_content['uri'] = generate_uri( { 'base_path': params['base_path'], 'dst_path': dst_path })                    
-                    folder_items.append(folder_content)
-                
+
         # Fetch content templates from theme, starting in the current folder and walking back up the folder tree
         # This allows overriding templates with ones from closer in the file tree
-        if theme_folder_templates: 
-            single_layout, list_layout, summary_layout = get_templates(template_env, theme_dir, folder)
+        with build.phase('templates'):
+            single_layout, list_layout, summary_layout = templates.get(folder)
 
-        if params.get('pretty_uris'):
-            dst_path = os.path.normpath(os.path.join(site_dir, folder, '{{ slug }}/index.html'))
+        if dirpath not in scanned:
+            site_output.extend(build.folder_lists.get(dirpath, ()))
+            continue
+
+        build.outputs = build.folder_outputs[dirpath] = set()
+        folder_params, folder_items, items = scanned.pop(dirpath)
+        has_list = not os.path.isfile(os.path.join(dirpath, 'index.html'))
+        if build.shard:
+            # The lists are made by merge_shards() once every shard is built.
+            own = [content for content in items if build.shard.owns(content['src_path'])]
+            render_pages(own, single_layout, build, graph, **folder_params)
+            build.shard.add_folder(dirpath, folder_params, folder_items, items, has_list)
         else:
-            dst_path = os.path.normpath(os.path.join(site_dir, folder, '{{ slug }}.html'))
-            
-        folder_items += make_pages(os.path.join(dirpath, '[!_]*.*'), dst_path, single_layout, **folder_params)
-
-        if not os.path.isfile(os.path.join(dirpath, 'index.html')):
-            if params.get('flatten_site_structure'):
-                folder_params['content'] = make_list(folder_items, None, list_layout, summary_layout, standalone=True, **folder_params)
-                log('Adding ' + dirpath)
-                site_output.append(folder_params)
-            else:
-                make_list(folder_items, os.path.normpath(os.path.join(site_dir, folder, 'index.html')),
-                list_layout, summary_layout, **folder_params)
+            folder_items += render_pages(items, single_layout, build, graph, **folder_params)
+            if has_list:
+                folder_output = make_folder_list(dirpath, folder_params, folder_items,
+                                                 list_layout, summary_layout, build, params)
+                if folder_output is not None:
+                    site_output.extend(folder_output)
+                    build.folder_lists[dirpath] = folder_output
+        build.outputs = None
+        # Only the metadata of the pages stays in the graph.
+        for content in items:
+            for key in BODY_KEYS:
+                content.maps[0].pop(key, None)
 
         # # Create RSS feeds.
         # make_list(blog_posts, '_site/blog/rss.xml',
         #           feed_xml, item_xml, type='blog', title='Blog', **params)
         # make_list(news_posts, '_site/news/rss.xml',
         #           feed_xml, item_xml, type='news', title='News', **params)
-    if params.get('flatten_site_structure'):
-        make_list(site_output, os.path.normpath(os.path.join(site_dir, 'index.html')), list_layout, item_layout = False, **params)
+    if params.get('flatten_site_structure') and not build.shard:
+        with build.phase('list'):
+            make_list(site_output, os.path.normpath(os.path.join(site_dir, 'index.html')), list_layout, item_layout = False, build=build, **params)
+
+def make_folder_list(dirpath, folder_params, folder_items, list_layout, summary_layout, build, params):
+    """Generate the list of a content folder.
+
+    If the site structure is flattened, the list is not written; the
+    items it adds to the site index are returned instead.
+    """
+    folder = os.path.relpath(dirpath, 'content')
+    site_dir = params.get('output_dir', '_site')
+    if not params.get('flatten_site_structure'):
+        with build.phase('list'):
+            make_list(folder_items, os.path.normpath(os.path.join(site_dir, folder, 'index.html')),
+            list_layout, summary_layout, build, **folder_params)
+        return None
+    with build.phase('list'):
+        output = make_list(folder_items, None, list_layout, summary_layout, build, standalone=True, **folder_params)
+    log('Adding ' + dirpath)
+    if isinstance(output, str):
+        folder_params['content'] = output
+        return [folder_params]
+    # Paginated, so each page of the folder's list is a separate item.
+    return [Context({'content': content, 'item_count': count}, folder_params)
+            for content, count in output]
+
+# Bump this whenever what Shard.save() writes changes so that fragments
+# saved by older versions are refused by merge_shards().
+SHARD_FORMAT_VERSION = 1
+
+class Shard:
+    """One of the independent runs a sharded build is split into, see --shard.
+
+    Every shard scans the metadata of the whole site, so that series
+    navigation is the same in each, but only renders the pages assigned
+    to it by a hash of their source path. The metadata lists need is
+    saved to a fragment, from which merge_shards() makes the lists.
+    """
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+        self.folders = []
+        self.items = {}
+
+    def owns(self, src_path):
+        """Return True if the page of src_path is rendered by this shard."""
+        digest = hashlib.md5(src_path.encode('utf-8')).hexdigest()
+        return int(digest, 16) % self.count == self.index - 1
+
+    def add_folder(self, dirpath, folder_params, folder_items, items, has_list):
+        """Record a content folder and the list metadata of this shard's pages in it."""
+        self.folders.append({
+            'dirpath': dirpath,
+            'params': dict(folder_params.maps[0]),
+            'folder_items': [dict(item) for item in folder_items],
+            'src_paths': [content['src_path'] for content in items],
+            'list': has_list,
+        })
+        for content in items:
+            if not self.owns(content['src_path']):
+                continue
+            item = {key: value for key, value in content.maps[0].items() if key not in BODY_KEYS}
+            if not content.get('summary'):
+                # Made from the text here, as make_list() would.
+                item['summary'] = truncate(content.get('content') or '')
+            self.items[content['src_path']] = item
+
+    def save(self, path, fingerprint):
+        """Write the shard's fragment, with the site_fingerprint() it was built with."""
+        fwrite_pickle(path, {'version': SHARD_FORMAT_VERSION, 'shard': (self.index, self.count),
+                             'fingerprint': fingerprint, 'folders': self.folders, 'items': self.items})
+
+def shard_dir(cache_dir, index, count):
+    """Return the folder the caches, manifest and fragment of a shard are kept in."""
+    return os.path.join(cache_dir, 'shards', '{}-of-{}'.format(index, count))
+
+def merge_shards(params, build, template_env, count):
+    """Generate the lists of a site built by count shards from their fragments.
+
+    No content file is read: the lists are made from the metadata the
+    shards recorded, and the outputs the shards wrote are added to the
+    build's manifest.
+    """
+    theme_dir = f"themes/{params.get('theme', 'default') }"
+    site_dir = params.get('output_dir', '_site')
+    cache_dir = params['build_options']['cache_dir']
+    fingerprint = site_fingerprint(params, theme_dir)
+
+    fragments = []
+    for index in range(1, count + 1):
+        path = os.path.join(shard_dir(cache_dir, index, count), 'fragment.pickle')
+        if not os.path.isfile(path):
+            raise ValueError(f'Shard {index}/{count} has not been built')
+        with open(path, 'rb') as f:
+            fragment = pickle.load(f)
+        if fragment.get('version') != SHARD_FORMAT_VERSION or fragment['fingerprint'] != fingerprint:
+            raise ValueError(f'Shard {index}/{count} was built with other params or templates')
+        fragments.append(fragment)
+        if build.manifest:
+            build.manifest.merge(OutputManifest(os.path.join(shard_dir(cache_dir, index, count),
+                                                             'output-manifest.json'), site_dir))
+    items = {}
+    for fragment in fragments:
+        items.update(fragment['items'])
+
+    templates = TemplateIndex(template_env, theme_dir)
+    site_output = list()
+    list_layout = None
+    for folder in fragments[0]['folders']:
+        dirpath = folder['dirpath']
+        with build.phase('templates'):
+            single_layout, list_layout, summary_layout = templates.get(os.path.relpath(dirpath, 'content'))
+        if not folder['list']:
+            continue
+        folder_params = Context(dict(folder['params']), params)
+        folder_items = [dict(item) for item in folder['folder_items']]
+        for src_path in folder['src_paths']:
+            if src_path not in items:
+                raise ValueError(f'No shard recorded {src_path}, rebuild the shards')
+            folder_items.append(Context(dict(items[src_path]), folder_params))
+        build.outputs = build.folder_outputs[dirpath] = set()
+        folder_output = make_folder_list(dirpath, folder_params, folder_items,
+                                         list_layout, summary_layout, build, params)
+        build.outputs = None
+        if folder_output is not None:
+            site_output.extend(folder_output)
+    if params.get('flatten_site_structure') and list_layout:
+        with build.phase('list'):
+            make_list(site_output, os.path.normpath(os.path.join(site_dir, 'index.html')), list_layout, item_layout = False, build=build, **params)
+
+def snapshot(paths):
+    """Return the mtime and size of every file and folder under paths."""
+    files = {}
+    for top in paths:
+        if os.path.isfile(top):
+            stat = os.stat(top)
+            files[top] = (stat.st_mtime_ns, stat.st_size)
+        # Like os.walk(), without stat() calls for the entries' types.
+        folders = [top] if os.path.isdir(top) else []
+        while folders:
+            dirpath = folders.pop()
+            files[dirpath] = None
+            try:
+                entries = list(os.scandir(dirpath))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        folders.append(entry.path)
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+def changed_folders(files, new_files):
+    """Compare two snapshots and return the content folders and files to build.
+
+    Returns (None, None) if a change outside the content folder means the
+    whole site has to be generated again. The set of files is None if every
+    page of the folders has to be rendered again, which is the case when a
+    folder was added or removed or an _index file changed.
+    """
+    folders = set()
+    sources = set()
+    for path in files.keys() | new_files.keys():
+        old, new = files.get(path, False), new_files.get(path, False)
+        if old == new:
+            continue
+        if os.path.relpath(path, 'content').startswith(os.pardir):
+            return None, None
+        if None in (old, new):
+            # A folder was added or removed; its parent may list it.
+            folder = path
+        elif os.path.basename(path).startswith('_index.'):
+            folder = os.path.dirname(path)
+        else:
+            folders.add(os.path.dirname(path))
+            if sources is not None:
+                sources.add(path)
+            continue
+        folders.add(folder)
+        if folder != 'content':
+            folders.add(os.path.dirname(folder))
+        sources = None
+    return folders, sources
+
+def changed_templates(files, new_files, theme_dir):
+    """Compare two snapshots and return the names of the templates that changed.
+
+    Returns None if anything else changed too, including templates being
+    added or removed, which can change the templates a folder uses.
+    """
+    templates_dir = os.path.join(theme_dir, 'templates')
+    names = set()
+    for path in files.keys() | new_files.keys():
+        old, new = files.get(path), new_files.get(path)
+        if old == new:
+            continue
+        name = os.path.relpath(path, templates_dir)
+        if name.startswith(os.pardir) or old is None or new is None:
+            return None
+        names.add(name.replace(os.sep, '/'))
+    return names
+
+def site_fingerprint(params, theme_dir):
+    """Return a digest of the params, theme templates and code that every page depends on.
+
+    The theme's templates are only listed, the templates a page uses are
+    recorded with the page in the output manifest.
+    """
+    relevant = {key: value for key, value in params.items() if key not in ('build_options', 'tag_rules')}
+    relevant['makesite'] = file_digest(os.path.abspath(__file__))
+    templates_dir = os.path.join(theme_dir, 'templates')
+    relevant['templates'] = sorted(os.path.relpath(os.path.join(dirpath, filename), templates_dir)
+                                   for dirpath, dirnames, filenames in os.walk(templates_dir)
+                                   for filename in filenames)
+    text = json.dumps(relevant, sort_keys=True, default=str)
+    return hashlib.md5(text.encode()).hexdigest()
+
+def template_digest(template_env, name):
+    """Return the md5 of the source of a template, or None if it can't be read."""
+    source = template_source(template_env, name)
+    return source and hashlib.md5(source.encode()).hexdigest()
+
+def changed_pages(manifest, fingerprint, template_env, files):
+    """Return the content files whose pages have to be generated again.
+
+    files is the snapshot() of the content folder and fingerprint the
+    site_fingerprint() of this build. Compared with the build recorded in
+    manifest, these are the changed content files and the pages that
+    show one or use a template that changed. Returns None if every page
+    has to be generated again.
+    """
+    if manifest.content is None or manifest.params != fingerprint:
+        return None
+    folders, sources = changed_folders(manifest.content, files)
+    if folders is None or sources is None:
+        return None
+    templates = {name for name, digest in manifest.templates.items()
+                 if template_digest(template_env, name) != digest}
+    outputs = manifest.dependents(templates, sources, previous=True)
+    return sources | {entry['page'] for entry in outputs.values() if entry.get('page')}
+
+def build_stamp(params, theme_dir, digests=False):
+    """Return what a build reads: its params and a snapshot() of its sources.
+
+    The sources are params.json, the theme, the content folder and this
+    script. If digests is true, the md5 of every file is included too.
+    """
+    params = {key: value for key, value in params.items() if key != 'tag_rules'}
+    files = snapshot(['params.json', theme_dir, 'content', os.path.abspath(__file__)])
+    if digests:
+        files = {path: stat and stat + (file_digest(path),) for path, stat in files.items()}
+    return {'params': json.dumps(params, sort_keys=True, default=str), 'files': files}
+
+def unchanged_since(stamp_path, params, theme_dir, digests=False):
+    """Return True if nothing a build reads changed since the build_stamp() in stamp_path.
+
+    Files are compared by mtime and size. If digests is true, files whose
+    mtime changed but whose md5 did not count as unchanged, and the stamp
+    is updated with their new mtime.
+    """
+    if not os.path.isfile(stamp_path):
+        return False
+    try:
+        stamp = json.loads(fread(stamp_path))
+        files = {path: stat and tuple(stat) for path, stat in stamp['files'].items()}
+    except (ValueError, KeyError, TypeError):
+        return False
+    current = build_stamp(params, theme_dir)
+    if stamp['params'] != current['params'] or files.keys() != current['files'].keys():
+        return False
+    touched = False
+    for path, stat in current['files'].items():
+        old = files[path]
+        if old == stat or None not in (old, stat) and old[:2] == stat:
+            continue
+        if not digests or None in (old, stat) or len(old) < 3 or old[1] != stat[1] \
+                or file_digest(path) != old[2]:
+            return False
+        files[path] = stat + old[2:]
+        touched = True
+    if touched:
+        stamp['files'] = files
+        fwrite(stamp_path, json.dumps(stamp))
+    return True
+
+def serve(site_dir, port):
+    """Serve site_dir over HTTP from a background thread."""
+    import http.server
+    import threading
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=site_dir)
+    server = http.server.ThreadingHTTPServer(('', port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log('Serving {} at http://localhost:{}/ ...', site_dir, port)
+    return server
+
+def watch(params, build, template_env, port=None, interval=0.5, check=False):
+    """Generate the site again whenever content, theme or params change.
+
+    Only the content folders with changes are generated again, and within
+    them only the changed pages; the pages in the same series are
+    generated again too, whichever folder they are in. Parsed
+    content is kept in the build's parse cache between rebuilds. Runs until
+    interrupted. If check is true, the internal links of the whole site are
+    checked after each rebuild.
+    """
+    theme_dir = f"themes/{params.get('theme', 'default') }"
+    site_dir = params.get('output_dir', '_site')
+    server = serve(site_dir, port) if port else None
+    files = snapshot(['params.json', 'content', theme_dir])
+    log('Watching for changes, press Ctrl+C to stop ...')
+    try:
+        while True:
+            time.sleep(interval)
+            new_files = snapshot(['params.json', 'content', theme_dir])
+            if new_files == files:
+                continue
+            folders, sources = changed_folders(files, new_files)
+            names = None
+            if folders is None and not params.get('flatten_site_structure'):
+                names = changed_templates(files, new_files, theme_dir)
+            files = new_files
+
+            start = time.perf_counter()
+            try:
+                if names is not None:
+                    # Only templates changed, so only the outputs made with them are built.
+                    folders, sources = build.template_dependents(names)
+                elif folders is None:
+                    params = load_params()
+                    theme_dir = f"themes/{params.get('theme', 'default') }"
+                    files = snapshot(['params.json', 'content', theme_dir])
+                if folders is None or names is not None:
+                    template_env = make_template_env(theme_dir, params['build_options'])
+                    if build.profiler:
+                        build.profiler.wrap_filters(template_env)
+                build.restart(folders, sources)
+                if folders is None:
+                    build.manifest.copy_tree(f'{ theme_dir }/static', site_dir)
+                make_site(params, build, template_env, folders)
+            except Exception as e:
+                log('ERROR: {}: {}', type(e).__name__, str(e))
+                continue
+            build.manifest.content = {path: stat for path, stat in files.items()
+                                      if not os.path.relpath(path, 'content').startswith(os.pardir)}
+            build.manifest.params = site_fingerprint(params, theme_dir)
+            build.manifest.remove_stale()
+            build.manifest.save()
+            if params['build_options'].get('deploy_dir'):
+                write_deploy_manifest(build.manifest, params['build_options']['deploy_dir'])
+            if check:
+                build.broken_links = check_links(build.manifest, params.get('base_path', '/'))
+            log('Done in {:.2f}s', time.perf_counter() - start)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server:
+            server.shutdown()
+
+def main(argv=()):
+    args = parse_args(argv)
+
+    sys.stdin.reconfigure(encoding='utf-8')
+    sys.stdout.reconfigure(encoding='utf-8')
+
+    params = load_params()
+
+    theme_dir = f"themes/{params.get('theme', 'default') }"
+    site_dir = params.get('output_dir', '_site')
+
+    build_options = params['build_options']
+    cache_dir = build_options['cache_dir']
+    # Each shard of a sharded build keeps its own caches and manifest, so
+    # that shards can run at the same time.
+    state_dir = shard_dir(cache_dir, *args.shard) if args.shard else cache_dir
+    deploy_dir = build_options.get('deploy_dir')
+
+    # A build of a site that has not changed since the last one stops
+    # here, before the caches, templates and content parsers are loaded.
+    skip_unchanged = build_options.get('skip_unchanged')
+    stamp_path = os.path.join(cache_dir, 'build-stamp.json')
+    stamped = skip_unchanged and not (args.watch or args.shard or args.merge or args.compile_theme
+                                      or args.clear_cache or args.no_cache or args.check_links
+                                      or args.profile is not None)
+    if stamped and os.path.isdir(site_dir) and \
+            unchanged_since(stamp_path, params, theme_dir, skip_unchanged == 'hash'):
+        log('Nothing changed since the last build of {}', site_dir)
+        if deploy_dir:
+            fwrite(os.path.join(deploy_dir, 'changes.json'),
+                   json.dumps({'added': [], 'changed': [], 'removed': []}, indent=1))
+        return None
+    # The stamp is saved again once the build succeeded.
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(stamp_path)
+    stamp = stamped and build_stamp(params, theme_dir, skip_unchanged == 'hash')
+
+    cache_path = os.path.join(state_dir, 'parse-cache.pickle')
+    summary_cache_path = os.path.join(state_dir, 'summary-cache.pickle')
+    render_cache_path = os.path.join(state_dir, 'render-cache.pickle')
+    if args.clear_cache:
+        for path in (cache_path, summary_cache_path, render_cache_path):
+            if os.path.isfile(path):
+                os.remove(path)
+    parse_cache = None
+    # Merging reads no content, and would evict every entry of the cache.
+    if build_options.get('cache') and not args.no_cache and not args.merge:
+        parse_cache = ParseCache(cache_path)
+    summaries = None
+    if build_options.get('summary_cache') and not args.no_cache:
+        summaries = SummaryCache(summary_cache_path)
+    renders = None
+    if build_options.get('render_cache') and not args.no_cache:
+        renders = RenderCache(render_cache_path, build_options.get('render_cache_size', RENDER_CACHE_SIZE))
+    workers = args.workers if args.workers is not None else build_options.get('workers', 1)
+    manifest = OutputManifest(os.path.join(state_dir, 'output-manifest.json'), site_dir)
+    build = Build(parse_cache, workers, manifest, summaries, build_options.get('low_memory'), renders)
+    if args.shard:
+        build.shard = Shard(*args.shard)
+    # The shards of a sharded build write to the same output folder, which
+    # the merge cleans up.
+    incremental = args.incremental or build_options.get('incremental') or args.shard or args.merge
+
+    # Create a new _site directory from scratch, unless only changed files
+    # should be written.
+    with build.phase('write'):
+        if os.path.isdir(site_dir) and not incremental:
+            shutil.rmtree(site_dir, ignore_errors=False)
+        if not args.shard:
+            manifest.copy_tree(f'{ theme_dir }/static', site_dir)
+
+    #Load Jinja2 templates
+    if args.compile_theme:
+        compile_theme(theme_dir, cache_dir)
+    template_env = make_template_env(theme_dir, build_options)
+    if args.profile is not None:
+        build.profiler = Profiler()
+        build.profiler.wrap_filters(template_env)
+
+    check = args.check_links or build_options.get('check_links')
+    if args.merge:
+        with build.phase('walk'):
+            merge_shards(params, build, template_env, args.merge)
+        with build.phase('write'):
+            manifest.remove_stale()
+            if deploy_dir:
+                write_deploy_manifest(manifest, deploy_dir)
+        if check:
+            with build.phase('check'):
+                build.broken_links = check_links(manifest, params.get('base_path', '/'))
+        build.close()
+        return build
+
+    if not os.path.isdir('content'):
+        shutil.copytree(f'sample-content/default', 'content')
+
+    # Only the pages whose sources changed since the last build are
+    # generated again if the output folder was kept.
+    files = snapshot(['content'])
+    fingerprint = site_fingerprint(params, theme_dir)
+    if incremental:
+        changed = changed_pages(manifest, fingerprint, template_env, files)
+        if changed is not None:
+            build.changed = changed
+            build.page_outputs = manifest.page_outputs()
+    manifest.content, manifest.params = files, fingerprint
+
+    with build.phase('walk'):
+        make_site(params, build, template_env)
+    if args.shard:
+        # Outputs no shard wrote are removed by the merge.
+        build.shard.save(os.path.join(state_dir, 'fragment.pickle'), fingerprint)
+    else:
+        with build.phase('write'):
+            manifest.remove_stale()
+            if deploy_dir:
+                write_deploy_manifest(manifest, deploy_dir)
+        if check:
+            with build.phase('check'):
+                build.broken_links = check_links(manifest, params.get('base_path', '/'))
+        # A site with broken links is checked again by the next build.
+        if stamp and not build.broken_links:
+            fwrite(stamp_path, json.dumps(stamp))
+
+    if args.watch:
+        manifest.save()
+        watch(params, build, template_env, args.port, check)
+    build.close()
+
+    if build.profiler:
+        profile_path = args.profile or os.path.join(state_dir, 'profile.json')
+        build.profiler.save(profile_path, build.timings)
+        build.profiler.summary(build.timings)
+        log('Profile saved to {}', profile_path)
+    return build
 
 # Test parameter to be set temporarily by unit tests.
 _test = None
 
 
 if __name__ == '__main__':
-    main()
+    build = main(sys.argv[1:])
+    if build and build.broken_links:
+        sys.exit(1)
@@ -0,0 +1,85 @@
+import unittest
+import glob
+import os
+
+import makesite
+
+
+SAMPLE_WORKS = sorted(
+    filename
+    for filename in glob.glob(os.path.join('sample-content', '**', '*.html'), recursive=True)
+    if '<div id="preface">' in makesite.fread(filename)
+)
+
+PARAMS = {
+    'tag_processing': {
+        'media_tags': ['fanfiction', 'fanart'],
+        'media_type_default': 'fanfiction',
+        'excluded_tags': [],
+        'merge_tags': [],
+    },
+    'merge_fieldnames': {'fandoms': 'fandom', 'characters': 'character'},
+}
+
+
+class AO3ParserTest(unittest.TestCase):
+    """Tests for the AO3 download parsers."""
+
+    def test_samples_found(self):
+        self.assertGreater(len(SAMPLE_WORKS), 0)
+
+    def test_lxml_matches_bs4(self):
+        for filename in SAMPLE_WORKS:
+            with self.subTest(filename=filename):
+                text = makesite.fread(filename)
+                self.assertEqual(makesite.extract_ao3_lxml(text),
+                                 makesite.extract_ao3_bs4(text))
+
+    def test_read_content_matches(self):
+        for filename in SAMPLE_WORKS:
+            with self.subTest(filename=filename):
+                bs4_content = makesite.read_content(
+                    filename, build_options={'ao3_parser': 'bs4'}, **PARAMS)
+                lxml_content = makesite.read_content(
+                    filename, build_options={'ao3_parser': 'lxml'}, **PARAMS)
+                self.assertEqual(lxml_content, bs4_content)
+
+    def test_read_metadata_matches(self):
+        for filename in SAMPLE_WORKS:
+            for parser in ('bs4', 'lxml'):
+                with self.subTest(filename=filename, parser=parser):
+                    content = makesite.read_content(
+                        filename, build_options={'ao3_parser': parser}, **PARAMS)
+                    del content['content'], content['chapters_content']
+                    metadata = makesite.read_metadata(
+                        filename, build_options={'ao3_parser': parser}, **PARAMS)
+                    self.assertEqual(metadata, content)
+
+    def test_markup_serialized_like_bs4(self):
+        text = makesite.fread(SAMPLE_WORKS[0]).replace(
+            '<div id="chapters" class="userstuff">',
+            '<div id="chapters" class="userstuff"><p title=\'a"b\' class=" x  y ">'
+            '1 &amp; 2<!-- c --><br><img src="x.png"><script>a<b</script></p>'
+            '<pre>  a\n <b> </b></pre>  \n  <span> </span>', 1)
+        self.assertEqual(makesite.extract_ao3_lxml(text), makesite.extract_ao3_bs4(text))
+
+    def test_merge_tags(self):
+        params = dict(PARAMS, tag_processing=dict(
+            PARAMS['tag_processing'], merge_tags=[['Colours', 'Colour Time!!']]))
+        content = makesite.read_content(
+            os.path.join('sample-content', 'default', 'Sample Chaptered Work.html'), **params)
+        self.assertEqual(content['fandom'], ['Colours'])
+        self.assertEqual(content['words'], 12345)
+
+
+class TagRulesTest(unittest.TestCase):
+    """Tests for TagRules class."""
+
+    def test_merge(self):
+        rules = makesite.TagRules({'merge_tags': [['A', 'B', 'C'], ['D', 'B']]})
+        self.assertEqual(rules.merge(['C', 'E', 'B', 'A']), ['A', 'E', 'D'])
+
+    def test_lookups_casefolded(self):
+        rules = makesite.TagRules({'excluded_tags': ['Fluff'], 'media_tags': ['Fanart', 'FANART']})
+        self.assertIn('fluff', rules.excluded_tags)
+        self.assertEqual(rules.media_tags, {'fanart': 'Fanart'})
@@ -0,0 +1,41 @@
+import unittest
+import glob
+import os
+import shutil
+
+import benchmark
+import makesite
+from test import path
+
+
+class GenerateTest(unittest.TestCase):
+    """Tests for benchmark.generate() function."""
+
+    def setUp(self):
+        self.site_path = path.temppath('benchmark')
+
+    def tearDown(self):
+        shutil.rmtree(self.site_path, ignore_errors=True)
+
+    def files(self):
+        files = {}
+        for filename in glob.glob(os.path.join(self.site_path, '**', '*.*'), recursive=True):
+            with open(filename, encoding='utf-8') as f:
+                files[os.path.relpath(filename, self.site_path)] = f.read()
+        return files
+
+    def test_reproducible(self):
+        benchmark.generate(self.site_path, works=5, posts=5, seed=1)
+        first = self.files()
+        shutil.rmtree(self.site_path)
+        benchmark.generate(self.site_path, works=5, posts=5, seed=1)
+        self.assertEqual(self.files(), first)
+        self.assertEqual(len([name for name in first if name.endswith('.html')]), 5)
+
+    def test_works_are_ao3_downloads(self):
+        benchmark.generate(self.site_path, works=1, chapters=1, posts=0, series=1)
+        filename = os.path.join(self.site_path, 'content', 'works', 'work0.html')
+        content = makesite.read_content(filename, tag_processing={}, build_options={})
+        self.assertEqual(content['content_type'], 'ao3_work')
+        self.assertEqual(len(content['fandom']), 1)
+        self.assertEqual(content['words'], 300)
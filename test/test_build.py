@@ -0,0 +1,85 @@
+import unittest
+import io
+import os
+import shutil
+import sys
+
+import makesite
+from test import path
+
+
+class ReadContentsTest(unittest.TestCase):
+    """Tests for Build.read_contents() method."""
+
+    def setUp(self):
+        self.blog_path = path.temppath('blog')
+        os.makedirs(self.blog_path)
+        self.filenames = []
+        for i in range(8):
+            filename = os.path.join(self.blog_path, '2018-01-0{}-post{}.md'.format(i + 1, i))
+            with open(filename, 'w') as f:
+                f.write('<!-- title: Post {} -->*Post {}*'.format(i, i))
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.blog_path)
+
+    def test_parallel_matches_serial(self):
+        serial = makesite.Build().read_contents(self.filenames)
+        build = makesite.Build(workers=2)
+        parallel = build.read_contents(self.filenames)
+        build.close()
+        self.assertEqual(parallel, serial)
+        self.assertEqual([c['title'] for c in parallel],
+                         ['Post {}'.format(i) for i in range(8)])
+
+    def test_bodies_read_when_needed(self):
+        build = makesite.Build(low_memory=True)
+        contents = build.scan_contents(self.filenames)
+        for filename, content in zip(self.filenames, contents):
+            content['src_path'] = filename
+        self.assertNotIn('content', contents[0])
+        needed = lambda content: content['title'] == 'Post 5'
+        self.assertEqual(list(build.read_bodies(contents, needed)), contents)
+        self.assertEqual([c.get('content') for c in contents].count(None), 7)
+        self.assertEqual(contents[5]['content'], '<p><em>Post 5</em></p>\n')
+
+    def test_files_logged_once(self):
+        for low_memory in (False, True):
+            cache = makesite.ParseCache(path.temppath('blog', 'parse-cache.pickle'))
+            build = makesite.Build(parse_cache=cache, low_memory=low_memory)
+            stderr, sys.stderr = sys.stderr, io.StringIO()
+            try:
+                contents = build.scan_contents(self.filenames)
+                for filename, content in zip(self.filenames, contents):
+                    content['src_path'] = filename
+                self.assertEqual(list(build.read_bodies(contents, lambda content: True)), contents)
+                logged = sys.stderr.getvalue()
+            finally:
+                sys.stderr = stderr
+            self.assertEqual(contents[5]['content'], '<p><em>Post 5</em></p>\n')
+            self.assertEqual(logged.count('Reading: '), 8)
+            self.assertNotIn('cached', logged)
+
+
+class ReleaseTest(unittest.TestCase):
+    """Tests for Build.release() method."""
+
+    def setUp(self):
+        self.content = {'title': 'Foo', 'content': '<p>Lorem ipsum</p>',
+                        'chapters_content': [{'content': '<p>Lorem ipsum</p>'}]}
+
+    def test_kept_by_default(self):
+        makesite.Build().release(self.content)
+        self.assertEqual(self.content['content'], '<p>Lorem ipsum</p>')
+        self.assertNotIn('summary', self.content)
+
+    def test_low_memory(self):
+        makesite.Build(low_memory=True).release(self.content)
+        self.assertEqual(self.content, {'title': 'Foo', 'content': '', 'chapters_content': [],
+                                        'summary': 'Lorem ipsum'})
+
+    def test_summary_kept(self):
+        self.content['summary'] = 'Bar'
+        makesite.Build(low_memory=True).release(self.content)
+        self.assertEqual(self.content['summary'], 'Bar')
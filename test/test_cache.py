@@ -0,0 +1,75 @@
+import unittest
+import os
+import shutil
+
+import makesite
+from test import path
+
+
+class ParseCacheTest(unittest.TestCase):
+    """Tests for ParseCache class."""
+
+    def setUp(self):
+        self.blog_path = path.temppath('blog')
+        self.cache_path = path.temppath('cache', 'parse-cache.pickle')
+        self.post_path = os.path.join(self.blog_path, 'foo.txt')
+        os.makedirs(self.blog_path)
+        with open(self.post_path, 'w') as f:
+            f.write('<!-- title: Foo -->Foo')
+
+    def tearDown(self):
+        shutil.rmtree(self.blog_path)
+        shutil.rmtree(path.temppath('cache'), ignore_errors=True)
+
+    def read(self, **params):
+        build = makesite.Build(makesite.ParseCache(self.cache_path))
+        content = build.read_content(self.post_path, **params)
+        build.parse_cache.save()
+        return content
+
+    def test_miss_then_hit(self):
+        cache = makesite.ParseCache(self.cache_path)
+        content, key = cache.lookup(self.post_path)
+        self.assertIsNone(content)
+        cache.store(self.post_path, key, {'title': 'Foo'})
+        cache.save()
+
+        cache = makesite.ParseCache(self.cache_path)
+        content, key = cache.lookup(self.post_path)
+        self.assertEqual(content, {'title': 'Foo'})
+        self.assertIsNone(key)
+
+    def test_content_change(self):
+        self.assertEqual(self.read()['title'], 'Foo')
+        with open(self.post_path, 'w') as f:
+            f.write('<!-- title: Bar -->Bar')
+        self.assertEqual(self.read()['title'], 'Bar')
+
+    def test_touched_file_reused(self):
+        self.read()
+        os.utime(self.post_path, (0, 0))
+        cache = makesite.ParseCache(self.cache_path)
+        content, key = cache.lookup(self.post_path)
+        self.assertEqual(content['title'], 'Foo')
+
+    def test_params_change(self):
+        self.assertEqual(self.read()['slug'], 'foo')
+        cache = makesite.ParseCache(self.cache_path)
+        content, key = cache.lookup(self.post_path, default_content_type='post')
+        self.assertIsNone(content)
+
+    def test_stale_entries_evicted(self):
+        self.read()
+        cache = makesite.ParseCache(self.cache_path)
+        cache.save()
+        cache = makesite.ParseCache(self.cache_path)
+        self.assertEqual(cache.entries, {})
+
+    def test_metadata_without_body(self):
+        self.read()
+        cache = makesite.ParseCache(self.cache_path)
+        content, key = cache.lookup_metadata(self.post_path)
+        self.assertEqual(content['title'], 'Foo')
+        self.assertNotIn('content', content)
+        content, key = cache.lookup(self.post_path)
+        self.assertEqual(content['content'], 'Foo')
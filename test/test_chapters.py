@@ -0,0 +1,117 @@
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import unittest
+
+import benchmark
+import makesite
+from test import path
+
+
+class ChapterPagesTest(unittest.TestCase):
+    """Tests for chapter_pages() function."""
+
+    def setUp(self):
+        self.work = {
+            'title': 'Foo',
+            'words': 3000,
+            'dst_path': '_site/works/foo/index.html',
+            'uri': '/works/foo',
+            'base_path': '/',
+            'content': 'One Two Three',
+            'chapters_content': [{'title': 'Chapter {}'.format(i), 'content': name}
+                                 for i, name in enumerate(['One', 'Two', 'Three'], 1)],
+            'display_options': {'chapter_pages': 3},
+        }
+
+    def test_not_split(self):
+        self.work['display_options'] = {'chapter_pages': 4}
+        self.assertEqual(makesite.chapter_pages(self.work), [])
+        self.work['display_options'] = {}
+        self.assertEqual(makesite.chapter_pages(self.work), [])
+
+    def test_split_by_words(self):
+        self.work['display_options'] = {'chapter_pages_words': 3000}
+        self.assertEqual(len(makesite.chapter_pages(self.work)), 4)
+
+    def test_chapter_pages(self):
+        work, one, two, three = makesite.chapter_pages(self.work)
+        self.assertEqual(work['dst_path'], '_site/works/foo/index.html')
+        self.assertEqual(work['content'], '')
+        self.assertEqual([c['uri'] for c in work['chapter_pages']],
+                         ['/works/foo/chapter-1', '/works/foo/chapter-2', '/works/foo/chapter-3'])
+        self.assertEqual(two['dst_path'], '_site/works/foo/chapter-2/index.html')
+        self.assertEqual(two['chapters_content'], [self.work['chapters_content'][1]])
+        self.assertEqual((two['prev_chapter_uri'], two['next_chapter_uri']),
+                         ('/works/foo/chapter-1', '/works/foo/chapter-3'))
+        self.assertIsNone(one['prev_chapter_uri'])
+        self.assertIsNone(three['next_chapter_uri'])
+        self.assertIsNone(two['full_work_uri'])
+        self.assertEqual(self.work['uri'], '/works/foo')
+
+    def test_full_work_page(self):
+        self.work['display_options']['full_work_page'] = True
+        pages = makesite.chapter_pages(self.work)
+        self.assertEqual(pages[-1]['dst_path'], '_site/works/foo/full/index.html')
+        self.assertEqual(pages[-1]['chapters_content'], self.work['chapters_content'])
+        self.assertEqual(pages[0]['full_work_uri'], '/works/foo/full')
+
+    def test_without_pretty_uris(self):
+        self.work['dst_path'] = '_site/works/foo.html'
+        pages = makesite.chapter_pages(self.work)
+        self.assertEqual(pages[1]['dst_path'], '_site/works/foo/chapter-1.html')
+
+    def test_nav_without_pretty_uris(self):
+        self.work['dst_path'] = '_site/works/foo.html'
+        self.work['uri'] = '/works/foo.html'
+        self.work['display_options']['full_work_page'] = True
+        self.work['pretty_uris'] = False
+        work, one, two, three, full = makesite.chapter_pages(self.work)
+        for theme in ('default', 'minimal', 'modular'):
+            template = makesite.make_template_env('themes/' + theme).get_template('chapter_nav.html.j2')
+            nav = template.render(two) + template.render(work)
+            self.assertIn('href="/works/foo/chapter-1.html"', nav)
+            self.assertIn('href="/works/foo/chapter-3.html"', nav)
+            self.assertIn('href="/works/foo.html"', nav)
+            self.assertIn('href="/works/foo/full.html"', nav)
+            self.assertNotIn('.html/"', nav)
+
+
+class MissingChapterPageTest(unittest.TestCase):
+    """Tests for chapter pages in builds that only render changed pages."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.site_path = path.temppath('chaptered')
+        os.makedirs(os.path.join(self.site_path, 'content', 'works'))
+        os.symlink(os.path.abspath('themes'), os.path.join(self.site_path, 'themes'))
+        os.chdir(self.site_path)
+        with open(os.path.join('content', 'works', 'work1.html'), 'w') as f:
+            f.write(benchmark.make_ao3_work(random.Random(1), 1, ['Fandom'], {}, 3, 1))
+        with open('params.json', 'w') as f:
+            json.dump({'display_options': {'chapter_pages': 2}, 'build_options': {'cache': False}}, f)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.site_path, ignore_errors=True)
+
+    def test_chapter_page_rendered_again(self):
+        params = makesite.load_params()
+        build = makesite.Build(manifest=makesite.OutputManifest(os.path.join('cache', 'output-manifest.json'),
+                                                                '_site'))
+        template_env = makesite.make_template_env('themes/default')
+        chapter = os.path.join('_site', 'works', 'work1', 'chapter-2', 'index.html')
+        stderr, sys.stderr = sys.stderr, io.StringIO()
+        try:
+            makesite.make_site(params, build, template_env)
+            os.remove(chapter)
+            # Nothing changed, as in an incremental build.
+            build.restart(changed=set())
+            makesite.make_site(params, build, template_env)
+        finally:
+            sys.stderr = stderr
+        self.assertTrue(os.path.isfile(chapter))
+        self.assertIn('works/work1/chapter-2/index.html', build.manifest.current)
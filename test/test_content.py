@@ -102,3 +102,17 @@ class ContentTest(unittest.TestCase):
 
         self.assertEqual(content['content'], '*Foo*')
         self.assertIsNone(self.mock_args)
+
+    def test_metadata_headers(self):
+        content = makesite.read_metadata(self.normal_post_path)
+        self.assertEqual(content['a'], '1')
+        self.assertEqual(content['b'], '2')
+        self.assertNotIn('content', content)
+
+    def test_header_text_bounded(self):
+        with open(self.normal_post_path, 'a') as f:
+            f.write('\n' + 'Bar ' * 1000)
+        for size in (1, 5, 16, 4096):
+            text = makesite.read_header_text(self.normal_post_path, size)
+            self.assertTrue(text.startswith('<!-- a: 1 -->\n<!-- b: 2 -->\nF'))
+        self.assertLess(len(makesite.read_header_text(self.normal_post_path, 16)), 64)
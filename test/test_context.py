@@ -0,0 +1,32 @@
+import unittest
+import makesite
+
+
+class ContextTest(unittest.TestCase):
+    """Tests for Context class."""
+
+    def setUp(self):
+        self.site = {'title': 'Site', 'author': 'Admin',
+                     'display_options': {'group_by': ['fandom']}}
+        self.folder = makesite.Context({'title': 'Blog'}, self.site)
+
+    def test_lookup_order(self):
+        page = makesite.Context({'title': 'Post'}, self.folder)
+        self.assertEqual(page['title'], 'Post')
+        self.assertEqual(page['author'], 'Admin')
+        self.assertEqual(dict(page)['title'], 'Post')
+
+    def test_assignment_does_not_leak(self):
+        self.folder['author'] = 'Bar'
+        self.assertEqual(self.folder['author'], 'Bar')
+        self.assertEqual(self.site['author'], 'Admin')
+
+    def test_nested_values_shared(self):
+        self.assertIs(self.folder['display_options'], self.site['display_options'])
+
+    def test_mutable_copies_once(self):
+        options = self.folder.mutable('display_options')
+        options['group_by'] = []
+        self.assertIs(self.folder.mutable('display_options'), options)
+        self.assertEqual(self.folder['display_options'], {'group_by': []})
+        self.assertEqual(self.site['display_options'], {'group_by': ['fandom']})
@@ -1,5 +1,6 @@
 import unittest
 import os
+import pickle
 import shutil
 
 import makesite
@@ -37,3 +38,26 @@ class FileIOTest(unittest.TestCase):
         self.assertTrue(os.path.isdir(dirpath))
         shutil.rmtree(path.temppath('foo'))
         self.assertEqual(text_read, text)
+
+    def test_fwrite_bare_filename(self):
+        cwd = os.getcwd()
+        os.chdir(path.temppath())
+        try:
+            makesite.fwrite('foo.txt', 'baz\n')
+            makesite.Build().write_stream('bar.html', ['qux'])
+            self.assertEqual(makesite.fread('foo.txt'), 'baz\n')
+            self.assertEqual(makesite.fread('bar.html'), 'qux')
+        finally:
+            os.remove('foo.txt')
+            os.remove('bar.html')
+            os.chdir(cwd)
+
+    def test_fwrite_pickle(self):
+        dirpath = path.temppath('foo', 'bar')
+        filepath = os.path.join(dirpath, 'foo.pickle')
+        makesite.fwrite_pickle(filepath, {'baz': [1, 2]})
+        with open(filepath, 'rb') as f:
+            obj = pickle.load(f)
+        self.assertEqual(os.listdir(dirpath), ['foo.pickle'])
+        shutil.rmtree(path.temppath('foo'))
+        self.assertEqual(obj, {'baz': [1, 2]})
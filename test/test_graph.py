@@ -0,0 +1,74 @@
+import unittest
+
+import makesite
+
+
+class ContentGraphTest(unittest.TestCase):
+    """Tests for ContentGraph class."""
+
+    def setUp(self):
+        self.graph = makesite.ContentGraph()
+        self.one = {'src_path': 'content/works/one.html', 'slug': 'one', 'title': 'One',
+                    'uri': '/works/one', 'dst_path': '_site/works/one/index.html', 'base_path': '/',
+                    'fandom': ['A', 'B'], 'series': [{'title': 'S', 'index': '1'}]}
+        self.two = {'src_path': 'content/drafts/two.html', 'slug': 'two', 'title': 'Two',
+                    'uri': '/drafts/two', 'dst_path': '_site/drafts/two/index.html', 'base_path': '/',
+                    'fandom': 'A', 'series': [{'title': 'S', 'index': '2'}]}
+        self.graph.set_folder('content/works', [self.one])
+        self.graph.set_folder('content/drafts', [self.two])
+        self.graph.index()
+
+    def test_lookups(self):
+        self.assertIs(self.graph.by_src_path['content/drafts/two.html'], self.two)
+        self.assertEqual(self.graph.by_slug['one'], [self.one])
+        self.assertIs(self.graph.by_uri['/drafts/two'], self.two)
+        self.assertEqual(self.graph.pages_with('fandom', 'A'), [self.one, self.two])
+        self.assertEqual(self.graph.pages_with('fandom', 'B'), [self.one])
+        self.assertEqual(self.graph.pages_with('fandom', 'C'), [])
+
+    def test_series_across_folders(self):
+        self.graph.series_nav(self.one)
+        self.graph.series_nav(self.two)
+        self.assertEqual(self.one['series'][0]['next'], {'uri': '/drafts/two', 'title': 'Two'})
+        self.assertNotIn('prev', self.one['series'][0])
+        self.assertEqual(self.two['series'][0]['prev'], {'uri': '/works/one', 'title': 'One'})
+
+    def test_folder_removed(self):
+        self.graph.series_nav(self.one)
+        self.graph.keep_folders(['content/works'])
+        self.graph.index()
+        self.graph.series_nav(self.one)
+        self.assertNotIn('next', self.one['series'][0])
+        self.assertNotIn('2', self.graph.series['S'])
+        self.assertNotIn('/drafts/two', self.graph.by_uri)
+        self.assertEqual(self.graph.pages_with('fandom', 'A'), [self.one])
+
+
+class SeriesTrackingTest(unittest.TestCase):
+    """Tests for Build.update_series() and Build.pages_to_render() methods."""
+
+    def setUp(self):
+        self.items = [{'src_path': 'a.html', 'dst_path': __file__, 'series': [{'title': 'S'}]},
+                      {'src_path': 'b.html', 'dst_path': __file__, 'series': [{'title': 'S'}]},
+                      {'src_path': 'c.html', 'dst_path': __file__}]
+        self.build = makesite.Build()
+        self.build.update_series(self.items)
+
+    def test_all_rendered(self):
+        self.assertEqual(self.build.pages_to_render(self.items), {'a.html', 'b.html', 'c.html'})
+
+    def test_series_touched(self):
+        self.build.restart(changed={'a.html'})
+        self.build.update_series(self.items[:1])
+        self.assertEqual(self.build.pages_to_render(self.items), {'a.html', 'b.html'})
+
+    def test_series_left(self):
+        self.build.restart(changed={'a.html'})
+        self.items[0]['series'] = []
+        self.build.update_series(self.items[:1])
+        self.assertEqual(self.build.pages_to_render(self.items), {'a.html', 'b.html'})
+
+    def test_removed_page(self):
+        self.build.restart(changed={'a.html'})
+        self.build.forget_pages(['a.html'])
+        self.assertEqual(self.build.pages_to_render(self.items[1:]), {'b.html'})
@@ -0,0 +1,93 @@
+import unittest
+import makesite
+
+
+class GroupRecursiveTest(unittest.TestCase):
+    """Tests for group_recursive() and flatten_by_attribute() functions."""
+
+    def setUp(self):
+        self.works = [
+            {'title': 'One', 'fandom': ['B', 'A'], 'series': [{'title': 'S', 'index': '2'}]},
+            {'title': 'Two', 'fandom': ['A']},
+            {'title': 'Three', 'fandom': ['A'], 'series': [{'title': 'S', 'index': '1'}]},
+        ]
+
+    def titles(self, output):
+        return [(group, [work['title'] for work in works], depth)
+                for group, works, depth in output]
+
+    def test_flatten_by_attribute(self):
+        flat = makesite.flatten_by_attribute(self.works, 'fandom')
+        self.assertEqual([(work['title'], work['fandom']) for work in flat],
+                         [('One', 'B'), ('One', 'A'), ('Two', 'A'), ('Three', 'A')])
+        self.assertEqual(self.works[0]['fandom'], ['B', 'A'])
+
+    def test_flatten_series(self):
+        flat = makesite.flatten_by_attribute(self.works, 'series')
+        self.assertEqual([(work['series'], work.get('series_index')) for work in flat],
+                         [('S', '2'), ('', None), ('S', '1')])
+
+    def test_group_recursive(self):
+        output = makesite.group_recursive(self.works, ['fandom', 'series'])
+        self.assertEqual(self.titles(output), [
+            ('A', [], 0),
+            ('', ['Two'], 1),
+            ('S', ['One', 'Three'], 1),
+            ('B', [], 0),
+            ('S', ['One'], 1),
+        ])
+        self.assertEqual(output[2][1][0]['fandom'], 'A')
+        self.assertEqual(output[2][1][0]['series_index'], '2')
+
+    def test_group_depth(self):
+        output = makesite.group_recursive(self.works, ['fandom', 'series'], 1)
+        self.assertEqual(self.titles(output), [
+            ('', ['Two'], 1),
+            ('S', ['One', 'Three'], 1),
+        ])
+
+
+class PaginateTest(unittest.TestCase):
+    """Tests for paginate() function."""
+
+    def setUp(self):
+        self.works = [{'title': str(i), 'fandom': ['A'] if i < 3 else ['B']} for i in range(5)]
+
+    def test_ungrouped(self):
+        pages = makesite.paginate(self.works, None, 2)
+        self.assertEqual([[work['title'] for work in items] for items, grouped in pages],
+                         [['0', '1'], ['2', '3'], ['4']])
+        self.assertEqual([grouped for items, grouped in pages], [None, None, None])
+
+    def test_headings_continued(self):
+        pages = makesite.paginate(self.works, ['fandom'], 2)
+        self.assertEqual([[(group, [w['title'] for w in works]) for group, works, depth in grouped]
+                          for items, grouped in pages],
+                         [[('A', ['0', '1'])], [('A', ['2']), ('B', ['3'])], [('B', ['4'])]])
+
+    def test_item_count(self):
+        parts = [{'title': 'Foo', 'item_count': 2}, {'title': 'Bar', 'item_count': 2},
+                 {'title': 'Baz', 'item_count': 1}]
+        pages = makesite.paginate(parts, None, 3)
+        self.assertEqual([[part['title'] for part in items] for items, grouped in pages],
+                         [['Foo'], ['Bar', 'Baz']])
+
+    def test_empty(self):
+        self.assertEqual(makesite.paginate([], ['fandom'], 2), [([], [])])
+
+
+class GroupFandomsTest(unittest.TestCase):
+    """Tests for group_fandoms() function."""
+
+    def test_groups(self):
+        rules = makesite.TagRules({'fandom_groups': [['G', 'A', 'B'], ['H', 'A']],
+                                   'no_fandom_label': 'None'})
+        works = [{'title': 'One', 'fandom': ['A', 'C']}, {'title': 'Two'}]
+        grouped = makesite.group_fandoms(rules, works)
+        self.assertEqual([(w['title'], w['fandom'], w.get('subfandom')) for w in grouped],
+                         [('One', 'G', 'A'), ('One', 'H', 'A'), ('One', 'C', None), ('Two', 'None', None)])
+        self.assertEqual(works[0]['fandom'], ['A', 'C'])
+
+    def test_no_groups(self):
+        works = [{'title': 'One', 'fandom': ['A']}]
+        self.assertIs(makesite.group_fandoms(makesite.TagRules({}), works), works)
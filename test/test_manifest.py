@@ -0,0 +1,217 @@
+import unittest
+import hashlib
+import json
+import os
+import shutil
+from unittest import mock
+
+import jinja2
+import makesite
+from test import path
+
+
+class OutputManifestTest(unittest.TestCase):
+    """Tests for OutputManifest class."""
+
+    def setUp(self):
+        self.site_path = path.temppath('site')
+        self.manifest_path = path.temppath('cache', 'output-manifest.json')
+        self.page_path = os.path.join(self.site_path, 'foo', 'index.html')
+
+    def tearDown(self):
+        shutil.rmtree(self.site_path, ignore_errors=True)
+        shutil.rmtree(path.temppath('cache'), ignore_errors=True)
+
+    def build(self, *pages):
+        manifest = makesite.OutputManifest(self.manifest_path, self.site_path)
+        written = [manifest.write(page, b'Foo') for page in pages]
+        manifest.remove_stale()
+        manifest.save()
+        return written
+
+    def test_unchanged_write_skipped(self):
+        self.assertEqual(self.build(self.page_path), [True])
+        os.utime(self.page_path, (0, 0))
+        self.assertEqual(self.build(self.page_path), [False])
+        self.assertEqual(os.path.getmtime(self.page_path), 0)
+
+    def test_missing_file_rewritten(self):
+        self.build(self.page_path)
+        os.remove(self.page_path)
+        self.assertEqual(self.build(self.page_path), [True])
+        self.assertTrue(os.path.isfile(self.page_path))
+
+    def test_stale_output_removed(self):
+        other_path = os.path.join(self.site_path, 'bar.html')
+        self.build(self.page_path, other_path)
+        self.build(other_path)
+        self.assertFalse(os.path.exists(os.path.dirname(self.page_path)))
+        self.assertTrue(os.path.isfile(other_path))
+
+    def test_restart_carries_over(self):
+        other_path = os.path.join(self.site_path, 'bar.html')
+        manifest = makesite.OutputManifest(self.manifest_path, self.site_path)
+        manifest.write(self.page_path, b'Foo')
+        manifest.write(other_path, b'Bar')
+        manifest.restart(dropped=[self.page_path])
+        manifest.remove_stale()
+        self.assertFalse(os.path.exists(self.page_path))
+        self.assertTrue(os.path.isfile(other_path))
+
+    def test_streamed_write(self):
+        build = makesite.Build(manifest=makesite.OutputManifest(self.manifest_path, self.site_path))
+        chunks = ['x' * 1000] * 2000
+        digest = build.write_stream(self.page_path, iter(chunks))
+        with open(self.page_path) as f:
+            self.assertEqual(f.read(), ''.join(chunks))
+        self.assertEqual(digest, build.manifest.current['foo/index.html']['digest'])
+        self.assertEqual(os.listdir(os.path.dirname(self.page_path)), ['index.html'])
+        build.manifest.save()
+        os.utime(self.page_path, (0, 0))
+        build = makesite.Build(manifest=makesite.OutputManifest(self.manifest_path, self.site_path))
+        build.write_stream(self.page_path, iter(chunks))
+        self.assertEqual(os.listdir(os.path.dirname(self.page_path)), ['index.html'])
+        self.assertEqual(os.path.getmtime(self.page_path), 0)
+
+
+class DependenciesTest(unittest.TestCase):
+    """Tests for the dependencies recorded in OutputManifest and changed_pages()."""
+
+    def setUp(self):
+        self.site_path = path.temppath('site')
+        self.manifest_path = path.temppath('cache', 'output-manifest.json')
+        self.page_path = os.path.join(self.site_path, 'foo', 'index.html')
+        self.list_path = os.path.join(self.site_path, 'index.html')
+        self.templates = {
+            'single.html.j2': '{% extends "base.html.j2" %}',
+            'base.html.j2': '{{ content }}',
+            'list.html.j2': '{% for item in items %}{{ item.title }}{% endfor %}',
+        }
+        self.template_env = jinja2.Environment(loader=jinja2.DictLoader(self.templates))
+        self.files = {'content': None, 'content/foo.md': (1, 10), 'content/bar.md': (1, 10)}
+
+    def tearDown(self):
+        shutil.rmtree(self.site_path, ignore_errors=True)
+        shutil.rmtree(path.temppath('cache'), ignore_errors=True)
+
+    def build(self):
+        build = makesite.Build(manifest=makesite.OutputManifest(self.manifest_path, self.site_path))
+        build.write_page(self.template_env.get_template('single.html.j2'),
+                         {'src_path': 'content/foo.md', 'dst_path': self.page_path, 'content': 'Foo'},
+                         ['content/bar.md'])
+        build.write_stream(self.list_path, ['Foo'])
+        build.depend(self.list_path, [self.template_env.get_template('list.html.j2')],
+                     ['content/foo.md', 'content/bar.md'])
+        build.manifest.content, build.manifest.params = self.files, 'params'
+        build.manifest.save()
+        return makesite.OutputManifest(self.manifest_path, self.site_path)
+
+    def changed(self, manifest, files=None):
+        return makesite.changed_pages(manifest, 'params', self.template_env, files or self.files)
+
+    def test_dependencies_saved(self):
+        manifest = self.build()
+        self.assertEqual(manifest.previous['foo/index.html']['templates'], ['base.html.j2', 'single.html.j2'])
+        self.assertEqual(manifest.previous['foo/index.html']['sources'], ['content/bar.md', 'content/foo.md'])
+        self.assertEqual(manifest.page_outputs(), {'content/foo.md': [self.page_path]})
+        self.assertEqual(list(manifest.dependents(templates=['list.html.j2'], previous=True)), ['index.html'])
+
+    def test_nothing_changed(self):
+        self.assertEqual(self.changed(self.build()), set())
+
+    def test_shown_source_changed(self):
+        files = dict(self.files)
+        files['content/bar.md'] = (2, 10)
+        self.assertEqual(self.changed(self.build(), files), {'content/foo.md', 'content/bar.md'})
+
+    def test_template_changed(self):
+        manifest = self.build()
+        self.templates['base.html.j2'] = '<p>{{ content }}</p>'
+        self.assertEqual(self.changed(manifest), {'content/foo.md'})
+        self.templates['base.html.j2'] = '{{ content }}'
+        self.templates['list.html.j2'] = ''
+        self.assertEqual(self.changed(manifest), set())
+
+    def test_everything_changed(self):
+        manifest = self.build()
+        self.assertIsNone(makesite.changed_pages(manifest, 'other', self.template_env, self.files))
+        files = dict(self.files, **{'content/_index.md': (1, 10)})
+        self.assertIsNone(self.changed(manifest, files))
+
+    def test_code_changed(self):
+        fingerprint = makesite.site_fingerprint({}, 'themes/default')
+        self.assertEqual(makesite.site_fingerprint({}, 'themes/default'), fingerprint)
+        code_path = path.temppath('cache', 'makesite.py')
+        makesite.fwrite(code_path, '# Changed\n')
+        with mock.patch.object(makesite, '__file__', code_path):
+            self.assertNotEqual(makesite.site_fingerprint({}, 'themes/default'), fingerprint)
+
+
+class DeployManifestTest(unittest.TestCase):
+    """Tests for write_deploy_manifest() function."""
+
+    def setUp(self):
+        self.site_path = path.temppath('site')
+        self.deploy_path = path.temppath('deploy')
+
+    def tearDown(self):
+        shutil.rmtree(self.site_path, ignore_errors=True)
+        shutil.rmtree(self.deploy_path, ignore_errors=True)
+
+    def build(self, files):
+        manifest = makesite.OutputManifest(path.temppath('deploy', 'unused.json'), self.site_path)
+        for name, text in files.items():
+            manifest.write(os.path.join(self.site_path, name), text)
+        return makesite.write_deploy_manifest(manifest, self.deploy_path)
+
+    def test_first_build(self):
+        changes = self.build({'index.html': b'Foo', 'css/style.css': b'Bar'})
+        self.assertEqual(changes, {'added': ['css/style.css', 'index.html'], 'changed': [], 'removed': []})
+        with open(os.path.join(self.deploy_path, 'manifest.json')) as f:
+            files = json.load(f)['files']
+        self.assertEqual(files['index.html'], {'size': 3, 'digest': hashlib.md5(b'Foo').hexdigest()})
+
+    def test_changes(self):
+        self.build({'index.html': b'Foo', 'foo.html': b'Foo', 'bar.html': b'Bar'})
+        changes = self.build({'index.html': b'Foo', 'foo.html': b'Baz', 'baz.html': b'Baz'})
+        self.assertEqual(changes, {'added': ['baz.html'], 'changed': ['foo.html'], 'removed': ['bar.html']})
+        with open(os.path.join(self.deploy_path, 'changes.json')) as f:
+            self.assertEqual(json.load(f), changes)
+
+
+class CheckLinksTest(unittest.TestCase):
+    """Tests for check_links() function."""
+
+    def setUp(self):
+        self.site_path = path.temppath('site')
+        self.manifest = makesite.OutputManifest(path.temppath('cache', 'output-manifest.json'), self.site_path)
+        self.write('index.html', '<a href="/works/foo/">Foo</a> <a href=\'works/bar.html\'>Bar</a>'
+                                 '<a href="https://example.com/">Out</a> <a href="#top">Top</a>'
+                                 '<a href="mailto:foo@example.com">Mail</a>')
+        self.write('works/foo/index.html', '<link href="/css/style.css"> <img src="../../missing.png">'
+                                           '<a href="/works/foo/?page=2#top">Again</a>')
+        self.write('works/bar.html', '<a href="/works/baz/">Baz</a> <a href="foo/index.html">Foo</a>')
+        self.write('css/style.css', 'a { }')
+        self.manifest.depend(os.path.join(self.site_path, 'works/foo/index.html'), [], ['content/works/foo.md'],
+                             'content/works/foo.md')
+
+    def tearDown(self):
+        shutil.rmtree(self.site_path, ignore_errors=True)
+
+    def write(self, name, text):
+        self.manifest.write(os.path.join(self.site_path, name), text.encode())
+
+    def test_broken_links(self):
+        self.assertEqual(makesite.check_links(self.manifest), {
+            'content/works/foo.md': ['../../missing.png'],
+            'works/bar.html': ['/works/baz/'],
+        })
+
+    def test_base_path(self):
+        self.write('index.html', '<a href="/base/works/foo">Foo</a> <a href="/base/bar/">Bar</a>'
+                                 '<a href="/other/">Other</a>')
+        self.write('works/bar.html', '')
+        self.assertEqual(makesite.check_links(self.manifest, '/base/'), {
+            'content/works/foo.md': ['../../missing.png'],
+            'index.html': ['/base/bar/'],
+        })
@@ -0,0 +1,63 @@
+import io
+import json
+import os
+import shutil
+import unittest
+from unittest import mock
+
+import makesite
+from test import path
+
+
+class ProfilerTest(unittest.TestCase):
+    """Tests for Profiler class."""
+
+    def setUp(self):
+        self.profile_path = path.temppath('profile', 'profile.json')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.profile_path), ignore_errors=True)
+
+    def test_disabled(self):
+        build = makesite.Build()
+        self.assertIs(build.profile('foo.md', 'render'), makesite.NOT_PROFILING)
+
+    def test_spans_saved(self):
+        build = makesite.Build()
+        build.profiler = makesite.Profiler()
+        with build.profile('foo.md', 'render', template='single.html.j2'):
+            pass
+        build.profiler.save(self.profile_path, {'render': 0.5})
+        with open(self.profile_path) as f:
+            report = json.load(f)
+        event, = report['traceEvents']
+        self.assertEqual(event['name'], 'foo.md')
+        self.assertEqual(event['ph'], 'X')
+        self.assertEqual(event['args'], {'template': 'single.html.j2'})
+        self.assertEqual(report['phases'], {'render': 0.5})
+
+    def test_filters_wrapped(self):
+        profiler = makesite.Profiler()
+        env = makesite.make_template_env('themes/default')
+        profiler.wrap_filters(env)
+        self.assertEqual(env.from_string('{{ 1500 | humanformat }}').render(), '1.5K')
+        self.assertEqual([(e['name'], e['cat']) for e in profiler.events],
+                         [('humanformat', 'filter')])
+
+    def test_writes_traced(self):
+        build = makesite.Build()
+        build.profiler = makesite.Profiler()
+        filename = os.path.join(os.path.dirname(self.profile_path), 'foo.html')
+        build.write_stream(filename, ['Foo'])
+        self.assertEqual([(e['name'], e['cat']) for e in build.profiler.events], [(filename, 'write')])
+
+    def test_writes_counted_once(self):
+        build = makesite.Build()
+        build.profiler = makesite.Profiler()
+        filename = os.path.join(os.path.dirname(self.profile_path), 'foo.html')
+        with build.profile(filename, 'render', template='single.html.j2'):
+            build.write_stream(filename, ['Foo'])
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            build.profiler.summary({'render': 0.5})
+        self.assertIn(' {} (1x)\n'.format(filename), stderr.getvalue())
+        self.assertIn(' single.html.j2 (1x)\n', stderr.getvalue())
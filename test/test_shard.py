@@ -0,0 +1,87 @@
+import unittest
+import os
+import pickle
+import shutil
+
+import makesite
+from test import path
+
+
+class ShardTest(unittest.TestCase):
+    """Tests for Shard class and merge_shards() function."""
+
+    def setUp(self):
+        self.site_path = path.temppath('site')
+        self.cache_path = path.temppath('cache')
+        self.params = {'theme': 'default', 'output_dir': self.site_path, 'base_path': '/',
+                       'build_options': {'cache_dir': self.cache_path},
+                       'display_options': {}, 'tag_processing': {}}
+        self.params['tag_rules'] = makesite.TagRules(self.params['tag_processing'])
+        self.template_env = makesite.make_template_env('themes/default')
+
+    def tearDown(self):
+        shutil.rmtree(self.site_path, ignore_errors=True)
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def build_shards(self, count):
+        folder_params = makesite.Context({'title': 'Works'}, self.params)
+        items = [makesite.Context({'src_path': 'content/works/work{}.md'.format(i), 'title': 'Work {}'.format(i),
+                                   'date': '2020-01-{:02}'.format(i + 1), 'words': 100, 'content': '<p>Text {}</p>'.format(i),
+                                   'uri': '/works/work{}'.format(i)}, folder_params)
+                  for i in range(10)]
+        fingerprint = makesite.site_fingerprint(self.params, 'themes/default')
+        shards = []
+        for index in range(1, count + 1):
+            shard = makesite.Shard(index, count)
+            shard.add_folder('content/works', folder_params, [], items, True)
+            shard.save(os.path.join(makesite.shard_dir(self.cache_path, index, count), 'fragment.pickle'),
+                       fingerprint)
+            shards.append(shard)
+        return shards
+
+    def test_pages_partitioned(self):
+        shards = [makesite.Shard(index, 3) for index in (1, 2, 3)]
+        for i in range(100):
+            src_path = 'content/works/work{}.html'.format(i)
+            self.assertEqual(sum(shard.owns(src_path) for shard in shards), 1)
+            self.assertEqual(makesite.Shard(2, 3).owns(src_path), shards[1].owns(src_path))
+
+    def test_fragment(self):
+        shard, = self.build_shards(1)
+        path = os.path.join(makesite.shard_dir(self.cache_path, 1, 1), 'fragment.pickle')
+        with open(path, 'rb') as f:
+            fragment = pickle.load(f)
+        self.assertEqual(fragment['shard'], (1, 1))
+        folder, = fragment['folders']
+        self.assertEqual(folder['params'], {'title': 'Works'})
+        self.assertEqual(folder['src_paths'][:2], ['content/works/work0.md', 'content/works/work1.md'])
+        item = fragment['items']['content/works/work3.md']
+        self.assertEqual(item['summary'], 'Text 3')
+        self.assertNotIn('content', item)
+
+    def test_merged_list(self):
+        self.build_shards(3)
+        build = makesite.Build()
+        makesite.merge_shards(self.params, build, self.template_env, 3)
+        with open(os.path.join(self.site_path, 'works', 'index.html')) as f:
+            text = f.read()
+        positions = [text.index('/works/work{}<'.format(i)) for i in range(10)]
+        self.assertEqual(positions, sorted(positions, reverse=True))
+        self.assertIn('Text 3', text)
+
+    def test_missing_shard(self):
+        self.build_shards(2)
+        with self.assertRaises(ValueError):
+            makesite.merge_shards(self.params, makesite.Build(), self.template_env, 3)
+
+
+class ParseShardTest(unittest.TestCase):
+    """Tests for parse_shard() function."""
+
+    def test_parse(self):
+        self.assertEqual(makesite.parse_shard('2/3'), (2, 3))
+
+    def test_invalid(self):
+        for text in ('0/3', '4/3', '3'):
+            with self.assertRaises(ValueError):
+                makesite.parse_shard(text)
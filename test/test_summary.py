@@ -0,0 +1,121 @@
+import unittest
+import os
+import shutil
+
+import jinja2
+import makesite
+from test import path
+
+
+class CountingTemplate(jinja2.Template):
+    renders = 0
+
+    def render(self, *args, **kwargs):
+        CountingTemplate.renders += 1
+        return super().render(*args, **kwargs)
+
+    def generate(self, *args, **kwargs):
+        CountingTemplate.renders += 1
+        return super().generate(*args, **kwargs)
+
+
+class SummaryCacheTest(unittest.TestCase):
+    """Tests for SummaryCache class."""
+
+    def setUp(self):
+        self.cache_path = path.temppath('cache', 'summary-cache.pickle')
+        loader = jinja2.DictLoader({
+            'summary.html.j2': '{% import "macros.html.j2" as m with context %}{{ title }}: {{ m.words(words) }}',
+            'macros.html.j2': '{% macro words(n) %}{{ n }} words by {{ author }}{% endmacro %}',
+        })
+        env = jinja2.Environment(loader=loader)
+        env.template_class = CountingTemplate
+        self.template = env.get_template('summary.html.j2')
+        CountingTemplate.renders = 0
+
+    def tearDown(self):
+        shutil.rmtree(path.temppath('cache'), ignore_errors=True)
+
+    def test_rendered_once(self):
+        cache = makesite.SummaryCache()
+        params = {'title': 'Foo', 'words': 10, 'author': 'Bar', 'content': 'Unused'}
+        self.assertEqual(cache.render(self.template, params), 'Foo: 10 words by Bar')
+        self.assertEqual(cache.render(self.template, dict(params, content='Other')),
+                         'Foo: 10 words by Bar')
+        self.assertEqual(CountingTemplate.renders, 1)
+
+    def test_used_values_in_key(self):
+        cache = makesite.SummaryCache()
+        cache.render(self.template, {'title': 'Foo', 'words': 10})
+        self.assertEqual(cache.render(self.template, {'title': 'Foo', 'words': 20}),
+                         'Foo: 20 words by ')
+        self.assertEqual(CountingTemplate.renders, 2)
+
+    def test_persisted(self):
+        cache = makesite.SummaryCache(self.cache_path)
+        cache.render(self.template, {'title': 'Foo'})
+        cache.save()
+        cache = makesite.SummaryCache(self.cache_path)
+        self.assertEqual(cache.render(self.template, {'title': 'Foo'}), 'Foo:  words by ')
+        self.assertEqual(CountingTemplate.renders, 1)
+
+
+class RenderCacheTest(unittest.TestCase):
+    """Tests for RenderCache class and Build.write_page() method."""
+
+    def setUp(self):
+        self.site_path = path.temppath('site')
+        self.cache_path = path.temppath('cache', 'render-cache.pickle')
+        self.manifest_path = path.temppath('cache', 'output-manifest.json')
+        loader = jinja2.DictLoader({
+            'single.html.j2': '{% extends "base.html.j2" %}{% block body %}{{ content }}{% endblock %}',
+            'base.html.j2': '<title>{{ title }}</title>{% block body %}{% endblock %}',
+        })
+        env = jinja2.Environment(loader=loader)
+        env.template_class = CountingTemplate
+        self.template = env.get_template('single.html.j2')
+        self.page = {'src_path': 'content/foo.md', 'title': 'Foo', 'content': 'Bar',
+                     'dst_path': os.path.join(self.site_path, 'foo.html')}
+        CountingTemplate.renders = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.site_path, ignore_errors=True)
+        shutil.rmtree(path.temppath('cache'), ignore_errors=True)
+
+    def build(self, page):
+        build = makesite.Build(manifest=makesite.OutputManifest(self.manifest_path, self.site_path),
+                               renders=makesite.RenderCache(self.cache_path))
+        md5 = build.write_page(self.template, page)
+        build.close()
+        return md5
+
+    def test_unchanged_page_skipped(self):
+        md5 = self.build(self.page)
+        os.utime(self.page['dst_path'], (0, 0))
+        self.assertEqual(self.build(self.page), md5)
+        self.assertEqual(CountingTemplate.renders, 1)
+        self.assertEqual(os.path.getmtime(self.page['dst_path']), 0)
+
+    def test_changed_value_rendered(self):
+        self.build(self.page)
+        self.build(dict(self.page, title='Baz'))
+        with open(self.page['dst_path']) as f:
+            self.assertEqual(f.read(), '<title>Baz</title>Bar')
+        self.assertEqual(CountingTemplate.renders, 2)
+
+    def test_missing_output_rendered(self):
+        self.build(self.page)
+        os.remove(self.page['dst_path'])
+        self.build(self.page)
+        self.assertTrue(os.path.isfile(self.page['dst_path']))
+        self.assertEqual(CountingTemplate.renders, 2)
+
+    def test_least_recently_used_evicted(self):
+        cache = makesite.RenderCache(self.cache_path, size=2)
+        cache.store('a', 'digest-a', 1)
+        cache.store('b', 'digest-b', 1)
+        cache.lookup('a')
+        cache.store('c', 'digest-c', 1)
+        cache.save()
+        cache = makesite.RenderCache(self.cache_path, size=2)
+        self.assertEqual(list(cache.entries), ['a', 'c'])
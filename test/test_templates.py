@@ -0,0 +1,82 @@
+import unittest
+import os
+import shutil
+
+import jinja2
+import makesite
+from test import path
+
+
+class TemplateEnvTest(unittest.TestCase):
+    """Tests for make_template_env() and compile_theme() functions."""
+
+    def setUp(self):
+        self.theme_path = path.temppath('theme')
+        self.cache_path = path.temppath('cache')
+        os.makedirs(os.path.join(self.theme_path, 'templates', 'works'))
+        self.write('single.html.j2', '{{ title }}')
+        self.write(os.path.join('works', 'single.html.j2'), 'Work: {{ title }}')
+        self.options = {'cache_dir': self.cache_path}
+
+    def tearDown(self):
+        shutil.rmtree(self.theme_path)
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def write(self, name, text):
+        with open(os.path.join(self.theme_path, 'templates', name), 'w') as f:
+            f.write(text)
+
+    def test_compiled_templates_used(self):
+        makesite.compile_theme(self.theme_path, self.cache_path)
+        env = makesite.make_template_env(self.theme_path, self.options)
+        self.assertIsInstance(env.loader, jinja2.ChoiceLoader)
+        template = env.get_template('works/single.html.j2')
+        self.assertTrue(template.filename.endswith('.py'))
+        self.assertEqual(template.render(title='Foo'), 'Work: Foo')
+
+    def test_stale_compiled_templates_ignored(self):
+        makesite.compile_theme(self.theme_path, self.cache_path)
+        self.write(os.path.join('works', 'single.html.j2'), 'Story: {{ title }}')
+        env = makesite.make_template_env(self.theme_path, self.options)
+        self.assertIsInstance(env.loader, jinja2.FileSystemLoader)
+        template = env.get_template('works/single.html.j2')
+        self.assertEqual(template.render(title='Foo'), 'Story: Foo')
+
+    def test_bytecode_cache(self):
+        self.options['template_cache'] = True
+        env = makesite.make_template_env(self.theme_path, self.options)
+        self.assertEqual(env.get_template('single.html.j2').render(title='Foo'), 'Foo')
+        self.assertTrue(os.listdir(os.path.join(self.cache_path, 'templates')))
+
+
+class TemplateIndexTest(unittest.TestCase):
+    """Tests for TemplateIndex class."""
+
+    def setUp(self):
+        self.theme_path = path.temppath('theme')
+        templates_path = os.path.join(self.theme_path, 'templates')
+        os.makedirs(os.path.join(templates_path, 'works', 'old'))
+        for name in ('single.html.j2', 'list.html.j2', 'summary.html.j2',
+                     'works/single.html.j2', 'works/old/list.html.j2'):
+            with open(os.path.join(templates_path, *name.split('/')), 'w') as f:
+                f.write(name)
+        env = makesite.make_template_env(self.theme_path)
+        self.index = makesite.TemplateIndex(env, self.theme_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.theme_path)
+
+    def names(self, folder):
+        return [template.render() for template in self.index.get(folder)]
+
+    def test_root_folder(self):
+        self.assertEqual(self.names('.'),
+                         ['single.html.j2', 'list.html.j2', 'summary.html.j2'])
+
+    def test_nearest_override(self):
+        folder = os.path.join('works', 'old', 'drafts')
+        self.assertEqual(self.names(folder),
+                         ['works/single.html.j2', 'works/old/list.html.j2', 'summary.html.j2'])
+
+    def test_memoized(self):
+        self.assertIs(self.index.get('works'), self.index.get('works'))
@@ -0,0 +1,196 @@
+import unittest
+import unittest.mock
+import io
+import json
+import os
+import random
+import shutil
+import sys
+
+import benchmark
+import makesite
+from test import path
+
+
+class ChangedFoldersTest(unittest.TestCase):
+    """Tests for changed_folders() function."""
+
+    def setUp(self):
+        self.works = os.path.join('content', 'works')
+        self.work = os.path.join(self.works, 'foo.html')
+        self.files = {
+            'params.json': (1, 10),
+            'content': None,
+            os.path.join('content', '_index.html'): (1, 10),
+            self.works: None,
+            os.path.join(self.works, '_index.html'): (1, 10),
+            self.work: (1, 10),
+        }
+
+    def test_changed_page(self):
+        new_files = dict(self.files)
+        new_files[self.work] = (2, 10)
+        self.assertEqual(makesite.changed_folders(self.files, new_files),
+                         ({self.works}, {self.work}))
+
+    def test_changed_index(self):
+        new_files = dict(self.files)
+        new_files[os.path.join(self.works, '_index.html')] = (2, 10)
+        self.assertEqual(makesite.changed_folders(self.files, new_files),
+                         ({self.works, 'content'}, None))
+
+    def test_removed_folder(self):
+        new_files = {path: stat for path, stat in self.files.items()
+                     if not path.startswith(self.works)}
+        self.assertEqual(makesite.changed_folders(self.files, new_files),
+                         ({self.works, 'content'}, None))
+
+    def test_changed_params(self):
+        new_files = dict(self.files)
+        new_files['params.json'] = (2, 10)
+        new_files[self.work] = (2, 10)
+        self.assertEqual(makesite.changed_folders(self.files, new_files), (None, None))
+
+
+class ChangedTemplatesTest(unittest.TestCase):
+    """Tests for changed_templates() function."""
+
+    def setUp(self):
+        self.templates = os.path.join('themes', 'default', 'templates')
+        self.summary = os.path.join(self.templates, 'works', 'summary.html.j2')
+        self.files = {
+            self.templates: None,
+            os.path.join(self.templates, 'works'): None,
+            self.summary: (1, 10),
+            os.path.join('content', 'foo.html'): (1, 10),
+        }
+
+    def test_changed_template(self):
+        new_files = dict(self.files)
+        new_files[self.summary] = (2, 10)
+        self.assertEqual(makesite.changed_templates(self.files, new_files, 'themes/default'),
+                         {'works/summary.html.j2'})
+
+    def test_added_template(self):
+        new_files = dict(self.files)
+        new_files[os.path.join(self.templates, 'single.html.j2')] = (1, 10)
+        self.assertIsNone(makesite.changed_templates(self.files, new_files, 'themes/default'))
+
+    def test_changed_content(self):
+        new_files = dict(self.files)
+        new_files[self.summary] = (2, 10)
+        new_files[os.path.join('content', 'foo.html')] = (2, 10)
+        self.assertIsNone(makesite.changed_templates(self.files, new_files, 'themes/default'))
+
+
+class UnchangedSinceTest(unittest.TestCase):
+    """Tests for build_stamp() and unchanged_since() functions."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.site_path = path.temppath('stamped')
+        os.makedirs(os.path.join(self.site_path, 'content'))
+        os.chdir(self.site_path)
+        self.page = os.path.join('content', 'foo.md')
+        with open(self.page, 'w') as f:
+            f.write('Foo')
+        self.stamp_path = os.path.join('cache', 'stamp.json')
+        self.params = {'title': 'Foo', 'tag_rules': makesite.TagRules({})}
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.site_path, ignore_errors=True)
+
+    def stamp(self, digests=False):
+        makesite.fwrite(self.stamp_path, json.dumps(makesite.build_stamp(self.params, 'theme', digests)))
+
+    def test_unchanged(self):
+        self.stamp()
+        self.assertTrue(makesite.unchanged_since(self.stamp_path, self.params, 'theme'))
+
+    def test_changed(self):
+        self.stamp()
+        self.assertFalse(makesite.unchanged_since(self.stamp_path, dict(self.params, title='Bar'), 'theme'))
+        os.utime(self.page, ns=(0, 0))
+        self.assertFalse(makesite.unchanged_since(self.stamp_path, self.params, 'theme'))
+
+    def test_added_file(self):
+        self.stamp()
+        os.mkdir('theme')
+        self.assertFalse(makesite.unchanged_since(self.stamp_path, self.params, 'theme'))
+
+    def test_digests(self):
+        self.stamp(digests=True)
+        os.utime(self.page, ns=(0, 0))
+        self.assertFalse(makesite.unchanged_since(self.stamp_path, self.params, 'theme'))
+        self.assertTrue(makesite.unchanged_since(self.stamp_path, self.params, 'theme', digests=True))
+        self.assertTrue(makesite.unchanged_since(self.stamp_path, self.params, 'theme'))
+        with open(self.page, 'w') as f:
+            f.write('Bar')
+        self.assertFalse(makesite.unchanged_since(self.stamp_path, self.params, 'theme', digests=True))
+
+    def test_missing_stamp(self):
+        self.assertFalse(makesite.unchanged_since(self.stamp_path, self.params, 'theme'))
+
+
+class WatchTest(unittest.TestCase):
+    """Tests for watch() function."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.site_path = path.temppath('watched')
+        os.makedirs(self.site_path)
+        os.symlink(os.path.abspath('themes'), os.path.join(self.site_path, 'themes'))
+        os.chdir(self.site_path)
+        # one and two are in a series, in different folders.
+        self.write('works', 'one', 1, 'Part 1 of\n<a href="http://archiveofourown.org/series/1">S</a>')
+        self.write('works', 'three', 3)
+        self.write('drafts', 'two', 2, 'Part 2 of\n<a href="http://archiveofourown.org/series/1">S</a>')
+        self.write('drafts', 'four', 4)
+        with open('params.json', 'w') as f:
+            json.dump({'build_options': {'cache': False}}, f)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.site_path, ignore_errors=True)
+
+    def write(self, folder, name, work_id, series=None):
+        text = benchmark.make_ao3_work(random.Random(work_id), work_id, ['Fandom'], {}, 1, 1)
+        if series:
+            text = text.replace('      <dt>Stats:</dt>',
+                                '        <dt>Series:</dt>\n        <dd> {} </dd>\n      <dt>Stats:</dt>'.format(series))
+        os.makedirs(os.path.join('content', folder), exist_ok=True)
+        with open(os.path.join('content', folder, name + '.html'), 'w') as f:
+            f.write(text)
+
+    def rendered(self, log):
+        return sorted(line.split()[1] for line in log.splitlines() if line.startswith('Rendering content/'))
+
+    def test_series_neighbour_rebuilt(self):
+        params = makesite.load_params()
+        build = makesite.Build(manifest=makesite.OutputManifest(os.path.join('cache', 'output-manifest.json'),
+                                                                '_site'))
+        template_env = makesite.make_template_env('themes/default')
+        stderr, sys.stderr = sys.stderr, io.StringIO()
+        try:
+            makesite.make_site(params, build, template_env)
+            self.assertEqual(len(self.rendered(sys.stderr.getvalue())), 4)
+
+            sleeps = []
+            def touch_once(seconds):
+                sleeps.append(seconds)
+                if len(sleeps) > 1:
+                    raise KeyboardInterrupt
+                stat = os.stat('content/works/one.html')
+                os.utime('content/works/one.html', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+                sys.stderr = io.StringIO()
+
+            with unittest.mock.patch('time.sleep', touch_once):
+                makesite.watch(params, build, template_env)
+            log = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(self.rendered(log), ['content/drafts/two.html', 'content/works/one.html'])
+        self.assertIn('Done in', log)
+        with open(os.path.join('_site', 'drafts', 'two', 'index.html')) as f:
+            self.assertIn('href="/works/one"', f.read())